@@ -0,0 +1,120 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import yaml
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.pbix_rewrite import generate_pbix
+from tests.fake_powerbi import FakePowerBI
+
+RDL_TEMPLATE = '<?xml version="1.0" encoding="utf-8"?><Report>{padding}</Report>'
+
+
+def build_scenario(workdir: Path, service: FakePowerBI, reports: int, workspaces: int, pbix_mb: int, rdl_every: int):
+    for index in range(workspaces):
+        service.add_workspace(f'workspace{index}', datasets=['Sales'])
+
+    template = generate_pbix(workdir / 'template.pbix', pbix_mb)
+    config = {'reports': []}
+    files = []
+    for index in range(reports):
+        name = f'report{index:04d}'
+        if rdl_every and index % rdl_every == 0:
+            path = workdir / f'{name}.rdl'
+            path.write_text(RDL_TEMPLATE.format(padding='x' * 10000), encoding='utf-8')
+        else:
+            path = workdir / f'{name}.pbix'
+            shutil.copy(template, path)
+        files.append(str(path))
+        config['reports'].append({
+            'name': name,
+            'dataset': 'Sales',
+            'environment': {'bench': {'workspace': f'workspace{index % workspaces}'}},
+        })
+
+    config_path = workdir / 'config.yaml'
+    config_path.write_text(yaml.safe_dump(config), encoding='utf-8')
+    return config_path, files
+
+
+def run_deployment(service: FakePowerBI, config_path: Path, files, jobs: int, extra_args):
+    env = {
+        **os.environ,
+        'TENANT_ID': 'bench-tenant',
+        'CLIENT_ID': 'bench-client',
+        'CLIENT_SECRET': 'bench-secret',
+        'POWERBI_API_URL': service.api_url,
+        'POWERBI_AUTHORITY_URL': service.authority_url,
+        'PYTHONPATH': str(ROOT),
+    }
+    args = [
+        sys.executable, '-m', 'report_deployer.app',
+        '--config', str(config_path),
+        '--files', ','.join(files),
+        '--env', 'bench',
+        '--jobs', str(jobs),
+        '--log-level', 'WARNING',
+        *extra_args,
+    ]
+    requests_before = sum(service.request_counts().values())
+    throttled_before = service.statuses[429]
+    start = time.perf_counter()
+    process = subprocess.Popen(args, cwd=config_path.parent, env=env)
+    # wait4 gives the peak RSS of this child alone rather than of all children so far
+    _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    peak_rss = usage.ru_maxrss / (1024 * 1024) if sys.platform == 'darwin' else usage.ru_maxrss / 1024
+    return {
+        'jobs': jobs,
+        'exit_code': os.waitstatus_to_exitcode(status),
+        'seconds': round(seconds, 2),
+        'requests': sum(service.request_counts().values()) - requests_before,
+        'throttled': service.statuses[429] - throttled_before,
+        'peak_rss_mb': round(peak_rss, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='end-to-end deployment benchmark against a local fake Power BI service')
+    parser.add_argument('--reports', type=int, default=40, help='number of reports in the generated config')
+    parser.add_argument('--workspaces', type=int, default=4, help='number of target workspaces')
+    parser.add_argument('--pbix-mb', type=int, default=20, help='size of each generated .pbix DataModel')
+    parser.add_argument('--rdl-every', type=int, default=5, help='make every Nth report an .rdl (0 for none)')
+    parser.add_argument('--jobs', type=str, default='1,4,8', help='comma-separated --jobs values to compare')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds of latency added to every API call')
+    parser.add_argument('--import-delay', type=float, default=2.0, help='seconds until an import reports Succeeded')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of API calls answered with 429')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='fraction of API calls answered with 500')
+    parser.add_argument('--json', type=str, help='write the results to this file')
+    parser.add_argument('deploy_args', nargs=argparse.REMAINDER, help='extra arguments passed to report_deployer.app after --')
+    args = parser.parse_args()
+    extra_args = [arg for arg in args.deploy_args if arg != '--']
+
+    results = []
+    print(f"{'jobs':>5}{'exit':>6}{'seconds':>10}{'requests':>10}{'429s':>7}{'peak rss MB':>13}")
+    for jobs in (int(value) for value in args.jobs.split(',')):
+        # Every run gets a fresh service and files so earlier runs do not warm anything up
+        with tempfile.TemporaryDirectory() as workdir, FakePowerBI(
+            latency=args.latency, import_delay=args.import_delay,
+            throttle_rate=args.throttle_rate, failure_rate=args.failure_rate, retry_after=1,
+        ) as service:
+            config_path, files = build_scenario(Path(workdir), service, args.reports, args.workspaces, args.pbix_mb, args.rdl_every)
+            result = run_deployment(service, config_path, files, jobs, extra_args)
+        results.append(result)
+        print(f"{result['jobs']:>5}{result['exit_code']:>6}{result['seconds']:>10}{result['requests']:>10}{result['throttled']:>7}{result['peak_rss_mb']:>13}")
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2), encoding='utf-8')
+
+
+if __name__ == '__main__':
+    main()
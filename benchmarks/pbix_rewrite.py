@@ -0,0 +1,84 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from report_deployer.files import copy_and_unpack_file, rewrite_connections
+
+IMPLEMENTATIONS = ('copy_and_unpack_file', 'rewrite_connections')
+
+
+def generate_pbix(path: Path, size_mb: int) -> Path:
+    block = os.urandom(1024 * 1024)
+    with zipfile.ZipFile(path, 'w') as pbix:
+        pbix.writestr('Version', '1.28', compress_type=zipfile.ZIP_DEFLATED)
+        pbix.writestr('Connections', json.dumps({'Version': 1}), compress_type=zipfile.ZIP_DEFLATED)
+        pbix.writestr('Report/Layout', 'layout' * 100000, compress_type=zipfile.ZIP_DEFLATED)
+        with pbix.open(zipfile.ZipInfo('DataModel'), 'w', force_zip64=True) as data_model:
+            for _ in range(size_mb):
+                data_model.write(block)
+    return path
+
+
+def max_rss_mb() -> float:
+    # ru_maxrss is reported in KiB on Linux and bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / (1024 * 1024) if sys.platform == 'darwin' else max_rss / 1024
+
+
+def run_once(implementation: str, pbix_path: Path) -> dict:
+    start = time.perf_counter()
+    if implementation == 'copy_and_unpack_file':
+        artifact = copy_and_unpack_file(pbix_path, 'benchmark-dataset', 'benchmark-workspace')
+        size = len(artifact)
+    else:
+        with rewrite_connections(pbix_path, 'benchmark-dataset') as artifact:
+            size = artifact.seek(0, os.SEEK_END)
+    return {
+        'implementation': implementation,
+        'seconds': round(time.perf_counter() - start, 3),
+        'peak_rss_mb': round(max_rss_mb(), 1),
+        'artifact_mb': round(size / (1024 * 1024), 1),
+    }
+
+
+def run_isolated(implementation: str, pbix_path: Path, workdir: Path) -> dict:
+    # Each implementation runs in a fresh interpreter so peak RSS is not shared
+    output = subprocess.run(
+        [sys.executable, __file__, '--run', implementation, '--pbix', str(pbix_path)],
+        cwd=workdir, check=True, capture_output=True, text=True,
+    ).stdout
+    return json.loads(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='compare .pbix Connections rewrite implementations')
+    parser.add_argument('--size-mb', type=int, default=300, help='size of the generated DataModel member')
+    parser.add_argument('--pbix', type=str, help='benchmark an existing .pbix instead of a generated one')
+    parser.add_argument('--run', choices=IMPLEMENTATIONS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_once(args.run, Path(args.pbix))))
+        return
+
+    with tempfile.TemporaryDirectory() as workdir:
+        workdir = Path(workdir)
+        pbix_path = Path(args.pbix).resolve() if args.pbix else generate_pbix(workdir / 'benchmark.pbix', args.size_mb)
+        print(f"source: {pbix_path} ({pbix_path.stat().st_size / (1024 * 1024):.1f} MB)")
+        print(f"{'implementation':<24}{'seconds':>10}{'peak rss MB':>14}{'artifact MB':>14}")
+        for implementation in IMPLEMENTATIONS:
+            result = run_isolated(implementation, pbix_path, workdir)
+            print(f"{result['implementation']:<24}{result['seconds']:>10}{result['peak_rss_mb']:>14}{result['artifact_mb']:>14}")
+
+
+if __name__ == '__main__':
+    main()
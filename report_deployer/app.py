@@ -1,27 +1,97 @@
 import argparse
 import os
-import yaml
+import signal
+import sys
+import threading
 from dotenv import load_dotenv
-import time
 import logging
-from report_deployer.auth import authenticate
-from report_deployer.workspace import get_workspace_id, get_dataset_id, post_import, get_import_id, get_imports, update_datasource, get_datasources
-from report_deployer.files import get_files, file_binary, copy_and_unpack_file
-from pydantic import BaseModel
+from report_deployer.auth import TokenProvider, AUTHORITY_URL
+from report_deployer.client import PowerBIClient, API_URL
+from report_deployer.workspace import NotFoundError, WorkspaceResolver, rebind_report, post_import, post_import_from_url, create_temporary_upload_location, update_datasource, get_datasources
+from report_deployer.upload import stream_size, upload_blob
+from report_deployer.files import ArtifactStore, file_hash, file_info, get_files, open_file, rewrite_connections, stream_hash
+from report_deployer.cache import MetadataCache, parse_ttls
+from report_deployer.artifacts import ArtifactCache
+from report_deployer.config import ConfigError, ConfigSource, ReportEntry, EnvironmentTarget, load_config, validate_files
+from report_deployer.manifest import DeploymentManifest
+from report_deployer.polling import ImportPoller, ImportFailedError
+from report_deployer.plan import DeploymentPlan, PlanEntry, PlanDriftError
+from report_deployer.principals import PrincipalPool, load_principals
+from report_deployer.scheduler import RequestScheduler
+from report_deployer.server import DeployJob, DeployServer, JobQueue
+from report_deployer.shard import assign_shards, parse_shard
+from report_deployer.journal import DeploymentJournal, PREPARED, UPLOADED, RESOLVED, DATASOURCE_UPDATED, DONE
+from report_deployer import metrics
+from report_deployer.pipeline import ByteBudget, DeploymentTask, run_deployments, log_summary
+from pydantic import BaseModel, ConfigDict
+from typing import Optional, Union
 import urllib.parse
+import requests
 
 logger = logging.getLogger(__name__)
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--config', type=str, required=True, help='path to the configuration file')
-    parser.add_argument('--files', type=str, required=True, help='path to the changelog files')
+    parser.add_argument('command', nargs='?', default='deploy', choices=['deploy', 'plan', 'apply', 'merge', 'serve'], help='deploy directly, write a deployment plan, apply a plan written earlier, merge the run reports of several shards, or accept deploy jobs over HTTP (default: deploy)')
+    parser.add_argument('--config', type=str, help='path to the configuration file')
+    parser.add_argument('--files', type=str, help='path to the changelog files')
     parser.add_argument('--separator', type=str, default=',', help='separator for the changelog files')
-    parser.add_argument('--env', type=str, required=True, help='environment to deploy the reports')
+    parser.add_argument('--plan', type=str, default='deployment-plan.json', help='plan file written by plan and read by apply')
+    parser.add_argument('--on-drift', type=str, default='resolve', choices=['resolve', 'refuse'], help='when applying a plan, look up IDs that no longer match the service again or fail the report')
+    parser.add_argument('--env', type=str, help='comma-separated environments to deploy the reports to, or "all" for every environment in the config')
+    parser.add_argument('--promote', action='store_true', help='with several environments, deploy a report to an environment only after it succeeded in the previous one')
     parser.add_argument('--log-level', type=str, default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], help='set the logging level')
     parser.add_argument('--log-file', type=str, help='path to the log file')
     parser.add_argument('--dry-run', action='store_true', help='simulate the deployment without making any changes')
-    return parser.parse_args()
+    parser.add_argument('--jobs', type=int, default=1, help='number of reports to deploy concurrently')
+    parser.add_argument('--workspace-jobs', type=int, default=2, help='maximum concurrent deployments into the same workspace')
+    parser.add_argument('--principals', type=str, help='YAML list of extra service principals (client_id, client_secret_env, optional tenant_id) to spread requests over')
+    parser.add_argument('--adaptive', action='store_true', help='pace upload, import polling and metadata calls separately, raising concurrency while calls succeed and halving it on 429s or latency spikes')
+    parser.add_argument('--token-cache', type=str, help='path to a token cache shared by concurrent runs on the same runner')
+    parser.add_argument('--manifest', type=str, help='path to the deployment manifest used to skip unchanged reports')
+    parser.add_argument('--force', action='store_true', help='deploy reports even if the manifest says they are unchanged')
+    parser.add_argument('--rebind', action='store_true', help='rebind .pbix reports whose content is unchanged but whose dataset changed instead of uploading them again (needs --manifest)')
+    parser.add_argument('--run-report', type=str, help='write a JSON report with per-stage timings and HTTP counts to this path')
+    parser.add_argument('--metrics-file', type=str, help='write the run metrics in OpenMetrics text format to this path')
+    parser.add_argument('--profile', action='store_true', help='capture cProfile and tracemalloc output for the prepare, upload and poll stages')
+    parser.add_argument('--profile-dir', type=str, default='report-deployer-profile', help='directory for --profile output')
+    parser.add_argument('--large-file-threshold', type=int, default=1024, help='size in MB above which .pbix files are uploaded through a temporary upload location')
+    parser.add_argument('--import-timeout', type=float, default=300, help='seconds to wait for an import to finish')
+    parser.add_argument('--poll-interval', type=float, default=0.5, help='initial import status poll interval, backs off up to --poll-max-interval')
+    parser.add_argument('--poll-max-interval', type=float, default=15, help='maximum import status poll interval')
+    parser.add_argument('--cache-file', type=str, help='path to a persistent workspace/dataset/import ID cache')
+    parser.add_argument('--cache-ttl', type=str, action='append', metavar='KIND=SECONDS', help='cache TTL for workspace, dataset or import IDs, can be repeated')
+    parser.add_argument('--admin-scan', action='store_true', help='resolve workspaces and datasets with one admin/groups scan (needs Power BI admin API access)')
+    parser.add_argument('--refresh-cache', action='store_true', help='ignore cached IDs and resolve everything again')
+    parser.add_argument('--artifact-cache', type=str, help='directory for rewritten .pbix files, reused across runs for the same source and dataset')
+    parser.add_argument('--artifact-cache-size', type=int, default=2048, help='size in MB above which the least recently used cached .pbix files are evicted')
+    parser.add_argument('--max-in-flight', type=int, metavar='MB', help='maximum MB of prepared artifacts waiting for or in upload at once, further preparation waits for uploads to finish')
+    parser.add_argument('--journal', type=str, help='record the stage each report reached in this file so an interrupted run can be resumed')
+    parser.add_argument('--resume', action='store_true', help='continue each report from the stage recorded in --journal instead of uploading it again')
+    parser.add_argument('--config-cache', type=str, help='directory for the compiled configuration, reused while the config file is unchanged')
+    parser.add_argument('--shard', type=str, metavar='INDEX/COUNT', help='deploy only this runner\'s share of the reports, split by target workspace and balanced by file size')
+    parser.add_argument('--shard-reports', type=str, nargs='+', metavar='PATH', help='run reports of every shard, combined by the merge command')
+    parser.add_argument('--listen', type=str, default='127.0.0.1:8765', metavar='HOST:PORT', help='address the serve command accepts deploy jobs on')
+    parser.add_argument('--server-workers', type=int, default=2, help='number of deploy jobs the serve command runs at once')
+    args = parser.parse_args()
+    if args.command == 'merge':
+        if not args.shard_reports:
+            parser.error("merge needs --shard-reports")
+    elif args.command == 'serve':
+        if not args.config:
+            parser.error("serve needs --config, the files and environments come with each job")
+    elif args.command != 'apply':
+        missing = [option for option in ('--config', '--files', '--env') if not getattr(args, option[2:])]
+        if missing:
+            parser.error(f"{args.command} needs {', '.join(missing)}")
+    if args.shard:
+        if args.command not in ('deploy', 'plan'):
+            parser.error("--shard only applies to deploy and plan, a plan is sharded when it is made")
+        try:
+            args.shard = parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+    return args
 
 def setup_logging(log_level, log_file=None):
     log_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
@@ -31,32 +101,6 @@ def setup_logging(log_level, log_file=None):
         logging.basicConfig(level=log_level, format=log_format)
     logger.setLevel(log_level)
 
-def load_config(config_path):
-    with open(config_path, 'r') as file:
-        return yaml.safe_load(file)
-
-def validate_config(file, config, environment):
-    report_config = next((report for report in config['reports'] if report['name'] == file['file_without_extension']), None)
-    if not report_config:
-        logger.error(f"File {file['file_without_extension']} not in the configuration file")
-        return None
-
-    dataset = report_config.get('dataset')
-    if not dataset:
-        logger.error(f"Dataset not found for {file['file_without_extension']}")
-        return None
-
-    display_name = report_config.get('display_name')
-    if not display_name:
-        logger.debug(f"Display name not found for {file['file_without_extension']}")
-
-    workspace_info = report_config['environment'].get(environment)
-    if not workspace_info:
-        logger.error(f"Environment {environment} not found for {file['file_without_extension']}")
-        return None
-    return report_config, workspace_info
-
-
 class ReportConfig(BaseModel):
     workspace: str
     workspace_id: str = None
@@ -70,21 +114,33 @@ class ReportConfig(BaseModel):
     report_id: str = None
 
 
-def generate_report_config(access_token: str, workspace: str, config: dict, environment: str) -> ReportConfig:
+def generate_report_config(client: PowerBIClient, workspace: str, config: ReportEntry, environment: str, resolver: WorkspaceResolver = None) -> ReportConfig:
+    resolver = resolver or WorkspaceResolver(client)
     report_config = ReportConfig(workspace=workspace)
-    report_config.dataset = config['dataset']
+    report_config.dataset = config.dataset
     report_config.environment = environment
-    report_config.subfolder = config['environment'].get(environment, {}).get('subfolder', None)
-    report_config.workspace_id = get_workspace_id(access_token, report_config.workspace)
-    report_config.dataset_id = get_dataset_id(access_token, report_config.workspace_id, report_config.dataset)
-    report_config.report_name = config.get('display_name') if config.get('display_name') else config.get('name')
-    report_config.import_id = get_imports(access_token, report_config.workspace_id, report_config.report_name)
+    target = config.environment.get(environment)
+    report_config.subfolder = target.subfolder if target else None
+    report_config.report_name = config.report_name
+    with metrics.span('resolve'):
+        report_config.workspace_id = resolver.workspace_id(report_config.workspace)
+        report_config.dataset_id = resolver.dataset_id(report_config.workspace_id, report_config.dataset)
+        report_config.import_id = resolver.import_id(report_config.workspace_id, report_config.report_name)
     report_config.existing = True if report_config.import_id else False
 
     return report_config
 
 
-def deploy_report(access_token, file, report_config, dry_run=False):
+LARGE_FILE_THRESHOLD = 1024 * 1024 * 1024
+
+
+def name_conflict(suffix, existing):
+    if existing:
+        return "CreateOrOverwrite" if suffix == "pbix" else "Overwrite"
+    return "Abort" if suffix != "pbix" else "CreateOrOverwrite"
+
+
+def deploy_report(client, file, report_config, dry_run=False, large_file_threshold=LARGE_FILE_THRESHOLD):
     if dry_run:
         logger.info(f"[DRY RUN] Would deploy report {report_config.report_name} to workspace {report_config.workspace}")
         return None
@@ -92,84 +148,643 @@ def deploy_report(access_token, file, report_config, dry_run=False):
     if report_config.existing:
         logger.info(f"Report {report_config.report_name} already exists in workspace {report_config.workspace}")
         logger.info("Will overwrite it now")
-        name_conflict = "CreateOrOverwrite" if file['suffix'] == "pbix" else "Overwrite"
     else:
         logger.info(f"Deploying {report_config.report_name} to workspace {report_config.workspace}...")
-        name_conflict = "Abort" if file['suffix'] != "pbix" else "CreateOrOverwrite"
+    conflict = name_conflict(file['suffix'], report_config.existing)
 
     display_name = f"{urllib.parse.quote(report_config.report_name)}{'.rdl' if file['suffix'] == 'rdl' else ''}"
     logger.info(f"Display name: {display_name}")
 
+    size = stream_size(file['binary'])
+    if file['suffix'] == 'pbix' and size > large_file_threshold:
+        logger.info(f"{file['name']} is {size} bytes, uploading through a temporary upload location")
+        file_url = create_temporary_upload_location(client, report_config.workspace_id)
+        metrics.count('bytes_uploaded', upload_blob(client, file_url, file['binary']))
+        return post_import_from_url(
+            client=client,
+            workspace_id=report_config.workspace_id,
+            file_url=file_url,
+            display_name=display_name,
+            name_conflict=conflict,
+            sub_folder=report_config.subfolder
+        )
+
     import_id = post_import(
-        access_token=access_token,
+        client=client,
         workspace_id=report_config.workspace_id,
         file=file,
         display_name=display_name,
-        name_conflict=name_conflict,
+        name_conflict=conflict,
         sub_folder=report_config.subfolder
     )
+    metrics.count('bytes_uploaded', size)
 
     return import_id
 
-def get_report_id_from_import_id(access_token, report_config, import_id, timeout=300, interval=5):
-    start_time = time.time()
-
-    while time.time() - start_time < timeout:
-        imports_data = get_import_id(access_token, report_config.workspace_id, import_id)
-        import_state = imports_data.get('importState')
-        logger.info(f"Import state: {import_state}")
-
-        if import_state == 'Succeeded':
-            reports = imports_data.get('reports', [])
-            if reports:
-                return reports[0]['id']
-            return None
-        elif import_state == 'Failed':
-            raise Exception(f"Import failed: {imports_data.get('error')}")
-        time.sleep(interval)
-
-    raise TimeoutError("Timeout while waiting for the import to finish")
+def get_report_id_from_import_id(client, report_config, import_id, timeout=300, poller=None):
+    poller = poller or ImportPoller(client)
+    imports_data = poller.wait(report_config.workspace_id, import_id, timeout)
+    reports = imports_data.get('reports', [])
+    if reports:
+        return reports[0]['id']
+    return None
+
+
+def prepare_artifact(file, report_config, artifacts=None, budget=None):
+    if budget is None:
+        return _prepare_artifact(file, report_config, artifacts)
+    # Wait until earlier artifacts have been uploaded and released before building another one
+    size = file['path'].stat().st_size
+    with metrics.span('budget_wait'):
+        budget.acquire(size)
+    try:
+        _prepare_artifact(file, report_config, artifacts)
+    except BaseException:
+        budget.release(size)
+        raise
+    file['binary'] = budget.hold(file['binary'], size)
+
+
+def _prepare_artifact(file, report_config, artifacts=None):
+    with metrics.span('prepare'):
+        if artifacts is not None:
+            file['binary'] = artifacts.open(file, report_config.dataset_id)
+        elif file['suffix'] == 'pbix':
+            file['binary'] = rewrite_connections(file['path'], report_config.dataset_id)
+        elif file['suffix'] == 'rdl':
+            file['binary'] = open_file(file['path'])
+
+
+def update_report_datasource(client, report_config):
+    with metrics.span('update_datasource'):
+        datasource = get_datasources(client, report_config.workspace_id, report_config.report_id)
+        data_source_name = next((item['name'] for item in datasource['value'] if 'name' in item), None)
+        logger.info(f"Data source name: {data_source_name}")
+        update_datasource(client, report_config.workspace_id, report_config.report_id, data_source_name, report_config.dataset_id)
 
 
-def process_file(access_token, file, report_config, dry_run=False):
-    if file['suffix'] == 'pbix':
-        file['binary'] = copy_and_unpack_file(file['path'], report_config.dataset_id, report_config.workspace)
-    if file['suffix'] == 'rdl':
-        file['binary'] = file_binary(file['path'])
+def process_file(client, file, report_config, dry_run=False, poller=None, import_timeout=300, large_file_threshold=LARGE_FILE_THRESHOLD, artifacts=None, budget=None, checkpoint=None):
+    checkpoint = checkpoint or (lambda stage: None)
+    if 'binary' not in file:
+        prepare_artifact(file, report_config, artifacts, budget)
+    checkpoint(PREPARED)
 
-    import_id = deploy_report(access_token, file, report_config, dry_run)
+    try:
+        with metrics.span('upload'):
+            import_id = deploy_report(client, file, report_config, dry_run, large_file_threshold)
+    finally:
+        # The artifact is streamed from disk or a spooled buffer and dropped once uploaded
+        file.pop('binary').close()
     if dry_run:
         logger.info(f"[DRY RUN] Would get import ID for report {report_config.report_name} in workspace {report_config.workspace} after succesful deployment")
         return
 
     logger.info(f"Import ID: {import_id}")
+    report_config.import_id = import_id
+    checkpoint(UPLOADED)
 
-    report_id = get_report_id_from_import_id(access_token, report_config, import_id)
+    with metrics.span('poll'):
+        report_id = get_report_id_from_import_id(client, report_config, import_id, import_timeout, poller)
 
     logger.info(f"Report ID: {report_id}")
+    report_config.report_id = report_id
+    checkpoint(RESOLVED)
 
     if file['suffix'] == 'rdl':
-        datasource = get_datasources(access_token, report_config.workspace_id, report_id)
-        data_source_name = next((item['name'] for item in datasource['value'] if 'name' in item), None)
-        logger.info(f"Data source name: {data_source_name}")
-        update_datasource(access_token, report_config.workspace_id, report_id, data_source_name, report_config.dataset_id)
+        update_report_datasource(client, report_config)
+        checkpoint(DATASOURCE_UPDATED)
+
+
+class DeploymentContext(BaseModel):
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    client: PowerBIClient
+    resolver: WorkspaceResolver
+    poller: ImportPoller
+    environment: str
+    manifest: Optional[DeploymentManifest] = None
+    force: bool = False
+    dry_run: bool = False
+    import_timeout: float = 300
+    large_file_threshold: int = LARGE_FILE_THRESHOLD
+    artifacts: Optional[Union[ArtifactStore, ArtifactCache]] = None
+    rebind: bool = False
+    budget: Optional[ByteBudget] = None
+    journal: Optional[DeploymentJournal] = None
+    on_drift: str = 'resolve'
+
+
+def skip_unchanged(context: DeploymentContext, file, report_config) -> bool:
+    if not context.manifest:
+        return False
+    if context.rebind and file['suffix'] == 'pbix':
+        # Rebinding compares sources, so the artifact is only built when it has to be uploaded
+        with metrics.span('hash'):
+            file['source_hash'] = file_hash(file['path'])
+        if context.force or not context.manifest.unchanged(context.environment, report_config, source_hash=file['source_hash']):
+            return False
+    else:
+        prepare_artifact(file, report_config, context.artifacts, context.budget)
+        with metrics.span('hash'):
+            file['artifact_hash'] = stream_hash(file['binary'])
+        if context.force or not context.manifest.unchanged(context.environment, report_config, file['artifact_hash']):
+            return False
+        file.pop('binary').close()
+    report_config.report_id = context.manifest.get(context.environment, report_config.workspace, report_config.report_name).report_id
+    logger.info(f"Report {report_config.report_name} is unchanged in workspace {report_config.workspace}, skipping upload")
+    return True
+
+
+def rebind_unchanged(context: DeploymentContext, file, report_config) -> bool:
+    if not context.rebind or context.force or not context.manifest or file['suffix'] != 'pbix':
+        return False
+    entry = context.manifest.get(context.environment, report_config.workspace, report_config.report_name)
+    if (
+        entry is None
+        or entry.source_hash != file.get('source_hash')
+        or entry.workspace_id != report_config.workspace_id
+        or entry.dataset_id == report_config.dataset_id
+    ):
+        return False
+    with metrics.span('rebind'):
+        report_id = context.resolver.report_id(report_config.workspace_id, report_config.report_name)
+        if report_id is None or report_id != entry.report_id:
+            logger.info(f"Report {report_config.report_name} in workspace {report_config.workspace} is not the one last deployed, uploading it")
+            return False
+        if context.dry_run:
+            logger.info(f"[DRY RUN] Would rebind report {report_config.report_name} in workspace {report_config.workspace} to dataset {report_config.dataset}")
+            return True
+        rebind_report(context.client, report_config.workspace_id, report_id, report_config.dataset_id)
+    report_config.report_id = report_id
+    logger.info(f"Report {report_config.report_name} is unchanged, rebound it to dataset {report_config.dataset} in workspace {report_config.workspace}")
+    return True
+
+
+def _source_hash(file):
+    if not file.get('source_hash'):
+        file['source_hash'] = file_hash(file['path'])
+    return file['source_hash']
+
+
+def _checkpoint(context: DeploymentContext, file, report):
+    if not context.journal:
+        return None
+    return lambda stage: context.journal.record(context.environment, report, stage, _source_hash(file), file.get('artifact_hash'))
+
+
+def resume_from_journal(context: DeploymentContext, file, report) -> Optional[str]:
+    entry = context.journal.get(context.environment, report) if context.journal else None
+    if (
+        entry is None
+        or entry.stage == PREPARED
+        or entry.workspace_id != report.workspace_id
+        or entry.dataset_id != report.dataset_id
+        or entry.source_hash != _source_hash(file)
+    ):
+        return None
+    logger.info(f"Resuming {report.report_name} in workspace {report.workspace} after stage {entry.stage}")
+    checkpoint = _checkpoint(context, file, report)
+    report.import_id = entry.import_id
+    report.report_id = entry.report_id
+    # The manifest is recorded with the hash of the artifact the interrupted run uploaded
+    file['artifact_hash'] = entry.artifact_hash
+    if entry.stage == UPLOADED:
+        try:
+            with metrics.span('poll'):
+                report.report_id = get_report_id_from_import_id(context.client, report, entry.import_id, context.import_timeout, context.poller)
+        except ImportFailedError as e:
+            logger.warning(f"Journaled import {entry.import_id} did not succeed ({e}), uploading {report.report_name} again")
+            file.pop('artifact_hash')
+            return None
+        logger.info(f"Report ID: {report.report_id}")
+        checkpoint(RESOLVED)
+    if file['suffix'] == 'rdl' and entry.stage in (UPLOADED, RESOLVED):
+        update_report_datasource(context.client, report)
+        checkpoint(DATASOURCE_UPDATED)
+    return entry.stage
+
+
+def _deploy(context: DeploymentContext, file, report) -> bool:
+    try:
+        stage = resume_from_journal(context, file, report)
+        if stage == DONE:
+            # Deployed by the interrupted run, which may have stopped before saving its manifest
+            _record_deployment(context, file, report)
+            return True
+        if stage:
+            return False
+        if skip_unchanged(context, file, report):
+            return True
+        if not rebind_unchanged(context, file, report):
+            process_file(
+                context.client, file, report, context.dry_run, context.poller, context.import_timeout,
+                context.large_file_threshold, context.artifacts, context.budget, _checkpoint(context, file, report),
+            )
+        return False
+    finally:
+        # A prepared artifact holds part of the byte budget until it is closed, also when hashing or a checkpoint failed
+        binary = file.pop('binary', None)
+        if binary is not None:
+            binary.close()
+
+
+def deploy_file(context: DeploymentContext, file, report_config: ReportEntry, target: EnvironmentTarget):
+    logger.info(f"report_config: {report_config}")
+    logger.info(f"target: {target}")
+    client, resolver = context.client, context.resolver
+    report = generate_report_config(client, target.workspace, report_config, context.environment, resolver)
+    logger.info(f"report: {report}")
+    try:
+        skipped = _deploy(context, file, report)
+    except requests.HTTPError as e:
+        not_found = e.response is not None and e.response.status_code == 404
+        if not not_found or not resolver.invalidate(report.workspace, report.workspace_id, report.dataset, report.report_name):
+            raise
+        logger.warning(f"Cached IDs for {report.report_name} returned 404, resolving them again")
+        report = generate_report_config(client, target.workspace, report_config, context.environment, resolver)
+        skipped = _deploy(context, file, report)
+    if skipped:
+        return True
+    _record_deployment(context, file, report)
+    return False
+
+
+def _record_deployment(context: DeploymentContext, file, report):
+    if context.dry_run:
+        return
+    context.resolver.record_import(report.workspace_id, report.report_name, report.import_id)
+    if context.manifest:
+        context.manifest.record(context.environment, report, file.get('artifact_hash'), file.get('source_hash'))
+    if context.journal:
+        context.journal.record(context.environment, report, DONE, _source_hash(file), file.get('artifact_hash'))
+
+
+def deployment_task(context: DeploymentContext, file, config, after=None, tag_environment=False):
+    # Files are checked against the config by validate_files before any task is built
+    report_config = config.report(file['file_without_extension'])
+    target = report_config.environment[context.environment]
+    environment = context.environment if tag_environment else None
+    # Every task gets its own copy since the prepared artifact and its hash are stored on the file
+    file = dict(file)
+
+    def run():
+        with metrics.report_context(file['file_without_extension'], environment):
+            return deploy_file(context, file, report_config, target)
+
+    return DeploymentTask(file['file_without_extension'], target.workspace, run, environment, after)
+
+
+def shard_targets(targets, config, shard, promote=False):
+    index, count = shard
+
+    def group(target):
+        environment, file = target
+        name = file['file_without_extension']
+        # A promoted report waits on its previous environment, so all its environments stay on one runner
+        return name if promote else (environment, config.report(name).environment[environment].workspace)
+
+    sizes = {}
+    for target in targets:
+        path = target[1]['path']
+        sizes[group(target)] = sizes.get(group(target), 0) + (path.stat().st_size if path.exists() else 0)
+    assignment = assign_shards(sizes, count)
+    selected = [target for target in targets if assignment[group(target)] == index]
+    logger.info(f"Shard {index}/{count}: {len(selected)} of {len(targets)} deployments")
+    return selected
+
+
+def deployment_targets(files, config, environments, promote=False, shard=None):
+    # Ordered by environment so a promoted report waits on a task queued before it
+    targets = [
+        (environment, file)
+        for environment in environments
+        for file in files
+        if environment in config.report(file['file_without_extension']).environment
+    ]
+    if shard:
+        targets = shard_targets(targets, config, shard, promote)
+    previous = {}
+    for index, (environment, file) in enumerate(targets):
+        name = file['file_without_extension']
+        yield environment, file, previous.get(name) if promote else None
+        previous[name] = index
+
+
+def deployment_tasks(context: DeploymentContext, files, config, environments, promote=False, shard=None):
+    contexts = {environment: context.model_copy(update={'environment': environment}) for environment in environments}
+    return [
+        deployment_task(contexts[environment], file, config, after, tag_environment=len(environments) > 1)
+        for environment, file, after in deployment_targets(files, config, environments, promote, shard)
+    ]
+
+
+def plan_deployment(context: DeploymentContext, files, config, environments, promote=False, shard=None) -> DeploymentPlan:
+    entries, errors, source_hashes = [], [], {}
+    for environment, file, after in deployment_targets(files, config, environments, promote, shard):
+        report_config = config.report(file['file_without_extension'])
+        try:
+            report = generate_report_config(context.client, report_config.environment[environment].workspace, report_config, environment, context.resolver)
+        except NotFoundError as e:
+            errors.append(f"{file['file_without_extension']} ({environment}): {e}")
+            continue
+        if file['path'] not in source_hashes:
+            source_hashes[file['path']] = file_hash(file['path'])
+        entries.append(PlanEntry(
+            **report.model_dump(exclude={'report_id'}),
+            name=file['file_without_extension'],
+            path=str(file['path']),
+            suffix=file['suffix'],
+            name_conflict=name_conflict(file['suffix'], report.existing),
+            source_hash=source_hashes[file['path']],
+            after=after,
+        ))
+    if errors:
+        raise ConfigError(errors)
+    return DeploymentPlan(environments=environments, entries=entries)
+
+
+def _planned_report(entry: PlanEntry) -> ReportConfig:
+    return ReportConfig(**entry.model_dump(include=set(ReportConfig.model_fields), exclude_none=True))
+
+
+def apply_entry(context: DeploymentContext, file, entry: PlanEntry):
+    if _source_hash(file) != entry.source_hash:
+        raise PlanDriftError(f"{file['name']} changed since the plan was made, plan again")
+    report = _planned_report(entry)
+    try:
+        skipped = _deploy(context, file, report)
+    except requests.HTTPError as e:
+        status = e.response.status_code if e.response is not None else None
+        if status not in (404, 409):
+            raise
+        if context.on_drift == 'refuse':
+            raise PlanDriftError(f"{entry.report_name} in workspace {entry.workspace} changed since the plan was made (HTTP {status}), plan again") from e
+        logger.warning(f"{entry.report_name} in workspace {entry.workspace} changed since the plan was made (HTTP {status}), resolving it again")
+        context.resolver.invalidate(entry.workspace, entry.workspace_id, entry.dataset, entry.report_name)
+        if status == 409:
+            # The report was published after planning, only its import has to be looked up
+            report = _planned_report(entry)
+            report.import_id = context.resolver.import_id(report.workspace_id, report.report_name)
+            report.existing = bool(report.import_id)
+        else:
+            report_config = ReportEntry(
+                name=entry.name,
+                display_name=entry.report_name,
+                dataset=entry.dataset,
+                environment={entry.environment: EnvironmentTarget(workspace=entry.workspace, subfolder=entry.subfolder)},
+            )
+            report = generate_report_config(context.client, entry.workspace, report_config, entry.environment, context.resolver)
+        skipped = _deploy(context, file, report)
+    if skipped:
+        return True
+    _record_deployment(context, file, report)
+    return False
+
+
+def apply_task(context: DeploymentContext, entry: PlanEntry, tag_environment=False):
+    file = file_info(entry.path)
+    environment = entry.environment if tag_environment else None
+
+    def run():
+        with metrics.report_context(entry.name, environment):
+            return apply_entry(context, file, entry)
+
+    return DeploymentTask(entry.name, entry.workspace, run, environment, entry.after)
+
+
+def apply_tasks(context: DeploymentContext, plan: DeploymentPlan):
+    contexts = {environment: context.model_copy(update={'environment': environment}) for environment in plan.environments}
+    return [apply_task(contexts[entry.environment], entry, tag_environment=len(plan.environments) > 1) for entry in plan.entries]
+
+
+def select_deployment(config, files, separator, env):
+    files = get_files(files, separator)
+    requested = None if env == 'all' else [environment.strip() for environment in env.split(',') if environment.strip()]
+    errors = validate_files(files, config, requested)
+    if errors:
+        raise ConfigError(errors)
+    return files, requested or config.environments()
+
+
+def load_deployment(args):
+    try:
+        config = load_config(args.config, args.config_cache)
+        files, environments = select_deployment(config, args.files, args.separator, args.env)
+    except ConfigError as e:
+        logger.error(str(e))
+        sys.exit(1)
+    return config, files, environments
+
+
+def create_client(args):
+    client = PowerBIClient(base_url=os.getenv('POWERBI_API_URL', API_URL), pool_size=max(10, args.jobs * 2))
+    client.scheduler = RequestScheduler() if args.adaptive else None
+    provider_args = {'session': client.session, 'cache_file': args.token_cache, 'authority': os.getenv('POWERBI_AUTHORITY_URL', AUTHORITY_URL)}
+    client.token_provider = TokenProvider(os.getenv('TENANT_ID'), os.getenv('CLIENT_ID'), os.getenv('CLIENT_SECRET'), **provider_args)
+    workspaces = []
+    if args.principals:
+        try:
+            providers = load_principals(args.principals, os.getenv('TENANT_ID'), **provider_args)
+        except ValueError as e:
+            logger.error(str(e))
+            sys.exit(1)
+        client.principals = PrincipalPool([client.token_provider, *providers])
+        workspaces = client.principals.discover(client)
+    else:
+        client.token_provider.token()
+    return client, workspaces
+
+
+def log_client_stats(client, run=None):
+    client.log_stats()
+    if client.principals:
+        client.principals.log_stats()
+    if client.scheduler:
+        client.scheduler.log_stats()
+        if run:
+            run.scheduler = client.scheduler.stats()
+
+
+def prepare_job(configs: ConfigSource, job: DeployJob):
+    config = configs.get()
+    files, environments = select_deployment(config, job.files, job.separator, job.env)
+    job.workspaces = sorted({
+        config.report(file['file_without_extension']).environment[environment].workspace
+        for environment, file, _ in deployment_targets(files, config, environments)
+    })
+    return files, config, environments
+
+
+def run_job(context: DeploymentContext, args, job: DeployJob, state):
+    files, config, environments = state
+    # Reports published since the previous job would be missing from the import lists
+    context.resolver.reset()
+    artifacts = context.artifacts or (ArtifactStore() if len(environments) > 1 else None)
+    job_context = context.model_copy(update={'force': context.force or job.force, 'dry_run': job.dry_run, 'artifacts': artifacts})
+    try:
+        tasks = deployment_tasks(job_context, files, config, environments, job.promote)
+        results = run_deployments(tasks, jobs=args.jobs, workspace_jobs=args.workspace_jobs)
+    finally:
+        if artifacts and artifacts is not context.artifacts:
+            artifacts.close()
+    if context.resolver.cache:
+        context.resolver.cache.save()
+    if context.manifest:
+        context.manifest.save()
+    log_summary(results)
+    return results
+
+
+def create_server(args) -> DeployServer:
+    configs = ConfigSource(args.config, args.config_cache)
+    try:
+        configs.get()
+    except ConfigError as e:
+        logger.error(str(e))
+        sys.exit(1)
+    client, workspaces = create_client(args)
+    cache = MetadataCache(args.cache_file, parse_ttls(args.cache_ttl), args.refresh_cache) if args.cache_file else None
+    # Shared by every job, so the token, connections, lookups and cached artifacts stay warm between them
+    context = DeploymentContext(
+        client=client,
+        resolver=WorkspaceResolver(client, cache, args.admin_scan),
+        poller=ImportPoller(client, args.poll_interval, args.poll_max_interval),
+        environment='',
+        manifest=DeploymentManifest(args.manifest) if args.manifest else None,
+        force=args.force,
+        import_timeout=args.import_timeout,
+        large_file_threshold=args.large_file_threshold * 1024 * 1024,
+        artifacts=ArtifactCache(args.artifact_cache, args.artifact_cache_size * 1024 * 1024) if args.artifact_cache else None,
+        rebind=args.rebind,
+        budget=ByteBudget(args.max_in_flight * 1024 * 1024) if args.max_in_flight else None,
+    )
+    context.resolver.add_workspaces(workspaces)
+    queue = JobQueue(lambda job: prepare_job(configs, job), lambda job, state: run_job(context, args, job, state), args.server_workers)
+
+    def close():
+        if context.artifacts:
+            context.artifacts.close()
+        log_client_stats(client)
+
+    host, _, port = args.listen.rpartition(':')
+    status = (lambda: {'scheduler': client.scheduler.stats()}) if client.scheduler else None
+    return DeployServer((host, int(port)), queue, close, status)
+
+
+def merge_shards(args):
+    try:
+        run, results, http = metrics.merge_run_reports(args.shard_reports)
+    except ValueError as e:
+        logger.error(str(e))
+        sys.exit(1)
+    if args.run_report:
+        run.write_json(args.run_report, results, http)
+    if args.metrics_file:
+        run.write_openmetrics(args.metrics_file, results, http)
+    metrics.write_github_summary(run, results, http)
+    if not log_summary(results):
+        sys.exit(1)
 
 
 def main():
     load_dotenv()
     args = parse_arguments()
     setup_logging(args.log_level, args.log_file)
-    config = load_config(args.config)
-    access_token = authenticate(os.getenv('TENANT_ID'), os.getenv('CLIENT_ID'), os.getenv('CLIENT_SECRET'))
-
-    files = get_files(args.files, args.separator)
-    for file in files:
-        report_config, workspace_config = validate_config(file, config, args.env)
-        logger.info(f"report_config: {report_config}")
-        logger.info(f"workspace_config: {workspace_config}")
-        report = generate_report_config(access_token, workspace_config['workspace'], report_config, args.env)
-        logger.info(f"report: {report}")
-        process_file(access_token, file, report, args.dry_run)
+    if args.command == 'merge':
+        merge_shards(args)
+        return
+    if args.command == 'serve':
+        server = create_server(args)
+        signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+        server.run()
+        return
+    run = metrics.start_run(args.profile_dir if args.profile else None)
+    if args.shard:
+        run.shard = '/'.join(map(str, args.shard))
+    if args.rebind and not args.manifest:
+        logger.error("--rebind needs --manifest to know which report content is already deployed")
+        sys.exit(1)
+    if args.resume and not args.journal:
+        logger.error("--resume needs --journal to know where the previous run stopped")
+        sys.exit(1)
+    if args.command == 'apply':
+        try:
+            plan = DeploymentPlan.load(args.plan)
+        except ValueError as e:
+            logger.error(str(e))
+            sys.exit(1)
+        plan.log()
+        environments = plan.environments
+    else:
+        config, files, environments = load_deployment(args)
+
+    client, workspaces = create_client(args)
+
+    artifacts = None
+    if args.command != 'plan' and args.artifact_cache:
+        artifacts = ArtifactCache(args.artifact_cache, args.artifact_cache_size * 1024 * 1024)
+    elif args.command != 'plan' and len(environments) > 1:
+        artifacts = ArtifactStore()
+    cache = MetadataCache(args.cache_file, parse_ttls(args.cache_ttl), args.refresh_cache) if args.cache_file else None
+    context = DeploymentContext(
+        client=client,
+        resolver=WorkspaceResolver(client, cache, args.admin_scan),
+        poller=ImportPoller(client, args.poll_interval, args.poll_max_interval),
+        environment=environments[0],
+        manifest=DeploymentManifest(args.manifest) if args.manifest else None,
+        force=args.force,
+        dry_run=args.dry_run,
+        import_timeout=args.import_timeout,
+        large_file_threshold=args.large_file_threshold * 1024 * 1024,
+        artifacts=artifacts,
+        rebind=args.rebind,
+        journal=DeploymentJournal(args.journal, args.resume) if args.journal and not args.dry_run and args.command != 'plan' else None,
+        budget=ByteBudget(args.max_in_flight * 1024 * 1024) if args.max_in_flight else None,
+        on_drift=args.on_drift,
+    )
+    context.resolver.add_workspaces(workspaces)
+
+    if args.command == 'plan':
+        try:
+            with metrics.span('plan'):
+                plan = plan_deployment(context, files, config, environments, args.promote, args.shard)
+        except ConfigError as e:
+            logger.error(str(e))
+            sys.exit(1)
+        finally:
+            if cache:
+                cache.save()
+        plan.log()
+        plan.write(args.plan)
+        log_client_stats(client, run)
+        if args.run_report:
+            run.write_json(args.run_report, http=client.stats())
+        return
+
+    tasks = apply_tasks(context, plan) if args.command == 'apply' else deployment_tasks(context, files, config, environments, args.promote, args.shard)
+    try:
+        results = run_deployments(tasks, jobs=args.jobs, workspace_jobs=args.workspace_jobs)
+    finally:
+        if context.artifacts:
+            context.artifacts.close()
+    if context.journal:
+        context.journal.close(completed=all(result.succeeded for result in results))
+    if context.budget:
+        logger.info(f"Peak prepared artifacts in flight: {context.budget.peak / (1024 * 1024):.1f} MB of {args.max_in_flight} MB")
+    if cache:
+        cache.save()
+    if context.manifest:
+        context.manifest.save()
+    log_client_stats(client, run)
+    http = client.stats()
+    if args.run_report:
+        run.write_json(args.run_report, results, http)
+    if args.metrics_file:
+        run.write_openmetrics(args.metrics_file, results, http)
+    metrics.write_github_summary(run, results, http)
+    run.write_profiles()
+    if not log_summary(results):
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,115 @@
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import BinaryIO
+from report_deployer.files import atomic_write, file_hash, open_file, write_connections
+from report_deployer import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 2 * 1024 * 1024 * 1024
+
+
+class ArtifactCache:
+    # Rewritten .pbix files on disk, keyed by source hash and dataset ID. The modification time
+    # is bumped on every hit and the least recently used files are evicted over max_size.
+    def __init__(self, directory, max_size: int = DEFAULT_MAX_SIZE):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._source_hashes = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _source_hash(self, file) -> str:
+        if file.get('source_hash'):
+            return file['source_hash']
+        stat = file['path'].stat()
+        key = (str(file['path']), stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._source_hashes.get(key)
+        if cached is None:
+            cached = file_hash(file['path'])
+            with self._lock:
+                self._source_hashes[key] = cached
+        return cached
+
+    def _key_lock(self, name):
+        with self._lock:
+            return self._key_locks.setdefault(name, threading.Lock())
+
+    def _count(self, stat):
+        with self._lock:
+            setattr(self, stat, getattr(self, stat) + 1)
+        metrics.count(f"artifact_cache_{stat}")
+
+    def open(self, file, dataset_id: str) -> BinaryIO:
+        if file['suffix'] != 'pbix':
+            return open_file(file['path'])
+        if not file['path'].exists():
+            raise FileNotFoundError(f"File {file['path']} not found or not a .pbix file")
+        name = f"{self._source_hash(file)}-{dataset_id}.pbix"
+        path = self.directory / name
+        with self._key_lock(name):
+            try:
+                stream = path.open('rb')
+            except FileNotFoundError:
+                stream = None
+            if stream is not None:
+                try:
+                    os.utime(path)
+                except FileNotFoundError:
+                    pass
+                self._count('hits')
+                return stream
+            self._count('misses')
+            self._write(file, dataset_id, path)
+            # The handle is opened before evicting, so the new entry stays readable even if it is evicted
+            stream = path.open('rb')
+        self._evict()
+        return stream
+
+    def _write(self, file, dataset_id, path):
+        with atomic_write(path, 'wb') as output:
+            write_connections(file['path'], dataset_id, output)
+
+    def _entries(self):
+        entries = []
+        for path in self.directory.glob('*.pbix'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _evict(self):
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                # Another process evicted it first
+                pass
+            else:
+                self._count('evictions')
+            total -= size
+
+    def size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def log_stats(self):
+        logger.info(
+            f"Artifact cache {self.directory}: {self.hits} hits, {self.misses} misses, {self.evictions} evictions, "
+            f"{self.size() / (1024 * 1024):.1f} MB of {self.max_size / (1024 * 1024):.0f} MB used"
+        )
+
+    def close(self) -> None:
+        self.log_stats()
@@ -1,7 +1,24 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
 import requests
+from report_deployer.files import atomic_write
 
-def authenticate(tenant_id, client_id, client_secret):
-    token_url = f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+AUTHORITY_URL = "https://login.microsoftonline.com"
+
+
+def request_token(tenant_id, client_id, client_secret, session=None, authority=AUTHORITY_URL):
+    token_url = f"{authority}/{tenant_id}/oauth2/v2.0/token"
     scope = "https://analysis.windows.net/powerbi/api/.default"
 
     data = {
@@ -11,7 +28,82 @@ def authenticate(tenant_id, client_id, client_secret):
         "grant_type": "client_credentials",
     }
 
-    response = requests.post(url=token_url, data=data)
+    response = (session or requests).post(url=token_url, data=data)
     response.raise_for_status()
-    access_token = response.json()['access_token']
+    return response.json()
+
+def authenticate(tenant_id, client_id, client_secret, session=None):
+    access_token = request_token(tenant_id, client_id, client_secret, session)['access_token']
     return access_token
+
+
+class TokenProvider:
+    def __init__(self, tenant_id, client_id, client_secret, session=None, refresh_margin=300, cache_file=None, authority=AUTHORITY_URL):
+        self.tenant_id = tenant_id
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.session = session
+        self.refresh_margin = refresh_margin
+        self.cache_file = Path(cache_file) if cache_file else None
+        self.authority = authority
+        self._lock = threading.Lock()
+        self._access_token = None
+        self._expires_at = 0.0
+
+    @property
+    def _cache_key(self):
+        return f"{self.tenant_id}:{self.client_id}"
+
+    def _fresh(self, expires_at):
+        return expires_at - self.refresh_margin > time.time()
+
+    def token(self):
+        with self._lock:
+            if not self._access_token or not self._fresh(self._expires_at):
+                self._refresh(stale_token=self._access_token)
+            return self._access_token
+
+    def refresh(self, stale_token):
+        # Called after a 401; concurrent callers holding the same stale token share one refresh
+        with self._lock:
+            if self._access_token == stale_token:
+                self._refresh(stale_token)
+            return self._access_token
+
+    def _refresh(self, stale_token):
+        with self._locked_cache() as cached:
+            entry = cached.get(self._cache_key)
+            if entry and entry['access_token'] != stale_token and self._fresh(entry['expires_at']):
+                self._access_token, self._expires_at = entry['access_token'], entry['expires_at']
+                return
+            response = request_token(self.tenant_id, self.client_id, self.client_secret, self.session, self.authority)
+            self._access_token = response['access_token']
+            self._expires_at = time.time() + int(response.get('expires_in', 3599))
+            cached[self._cache_key] = {'access_token': self._access_token, 'expires_at': self._expires_at}
+        logger.info(f"Acquired access token for {self.client_id}, expires in {int(self._expires_at - time.time())}s")
+
+    @contextmanager
+    def _locked_cache(self):
+        if not self.cache_file:
+            yield {}
+            return
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(f"{self.cache_file}.lock", 'w') as lock:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                cached = {}
+                if self.cache_file.exists():
+                    try:
+                        cached = json.loads(self.cache_file.read_text(encoding='utf-8'))
+                    except ValueError:
+                        cached = {}
+                before = dict(cached)
+                yield cached
+                if cached != before:
+                    # mkstemp creates the file readable by the owner only
+                    with atomic_write(self.cache_file) as f:
+                        json.dump(cached, f)
+            finally:
+                if fcntl:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
@@ -0,0 +1,84 @@
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+from report_deployer.files import atomic_write
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTLS = {
+    'workspace': 7 * 24 * 3600,
+    'dataset': 24 * 3600,
+    'import': 24 * 3600,
+}
+
+
+def parse_ttls(values: Optional[List[str]]) -> Dict[str, int]:
+    ttls = {}
+    for value in values or []:
+        kind, _, seconds = value.partition('=')
+        if kind not in DEFAULT_TTLS or not seconds.isdigit():
+            raise ValueError(f"Invalid cache TTL {value!r}, expected KIND=SECONDS with KIND in {', '.join(DEFAULT_TTLS)}")
+        ttls[kind] = int(seconds)
+    return ttls
+
+
+class MetadataCache:
+    def __init__(self, path, ttls: Dict[str, int] = None, refresh: bool = False):
+        self.path = Path(path)
+        self.ttls = {**DEFAULT_TTLS, **(ttls or {})}
+        self._lock = threading.Lock()
+        self._entries = {} if refresh else self._load()
+        self._dirty = refresh
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self):
+        if not self.path.exists():
+            return {}
+        try:
+            with self.path.open('r', encoding='utf-8') as f:
+                return json.load(f).get('entries', {})
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable metadata cache {self.path}: {e}")
+            return {}
+
+    @staticmethod
+    def _key(kind, parts):
+        return ':'.join((kind,) + tuple(str(part) for part in parts))
+
+    def get(self, kind: str, *parts) -> Optional[str]:
+        key = self._key(kind, parts)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and time.time() - entry['stored_at'] < self.ttls[kind]:
+                self.hits += 1
+                return entry['value']
+            if entry:
+                del self._entries[key]
+                self._dirty = True
+            self.misses += 1
+            return None
+
+    def set(self, kind: str, *parts, value: str) -> None:
+        with self._lock:
+            self._entries[self._key(kind, parts)] = {'value': value, 'stored_at': time.time()}
+            self._dirty = True
+
+    def invalidate(self, kind: str, *parts) -> bool:
+        with self._lock:
+            removed = self._entries.pop(self._key(kind, parts), None) is not None
+            self._dirty = self._dirty or removed
+            return removed
+
+    def save(self) -> None:
+        with self._lock:
+            if not self._dirty:
+                return
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with atomic_write(self.path) as f:
+                json.dump({'version': 1, 'entries': self._entries}, f, indent=2, sort_keys=True)
+            self._dirty = False
+        logger.info(f"Metadata cache saved to {self.path} ({self.hits} hits, {self.misses} misses)")
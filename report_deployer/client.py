@@ -0,0 +1,189 @@
+import email.utils
+import logging
+import random
+import re
+import threading
+import time
+import urllib.parse
+from datetime import datetime, timezone
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+API_URL = 'https://api.powerbi.com/v1.0/myorg'
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Statuses that guarantee the service did not act on a non-idempotent request
+UNPROCESSED_STATUSES = {429, 503}
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+ID_SEGMENT = re.compile(r'^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$')
+
+
+def endpoint_name(method, url, base_url=API_URL):
+    path = url.split('?', 1)[0]
+    if path.startswith(base_url):
+        path = path[len(base_url):]
+    else:
+        path = urllib.parse.urlsplit(path).path
+    segments = ['{id}' if ID_SEGMENT.match(segment) else segment for segment in path.strip('/').split('/')]
+    return f"{method} /{'/'.join(segments)}"
+
+
+def retry_after_seconds(response):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def _rewind(kwargs):
+    # Request bodies backed by file objects are consumed by the first attempt
+    bodies = list((kwargs.get('files') or {}).values()) + [kwargs.get('data')]
+    for body in bodies:
+        if hasattr(body, 'seek'):
+            body.seek(0)
+
+
+class PowerBIClient:
+    def __init__(self, access_token=None, base_url=API_URL, session=None, pool_size=10,
+                 max_retries=5, backoff=1.0, max_backoff=60.0, timeout=300, token_provider=None):
+        self.base_url = base_url.rstrip('/')
+        self.session = session or requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.headers = {}
+        self.token_provider = token_provider
+        # A PrincipalPool, when set, signs each request with one of several service principals instead
+        self.principals = None
+        # A RequestScheduler, when set, holds each authenticated call until its endpoint class has room
+        self.scheduler = None
+        self._stats_lock = threading.Lock()
+        self._stats = {}
+        if access_token:
+            self.authorize(access_token)
+
+    def authorize(self, access_token):
+        self.headers = {'Authorization': f'Bearer {access_token}'}
+
+    def _signer(self, url):
+        if self.principals:
+            return self.principals.route(url)
+        return self.token_provider
+
+    def _auth_headers(self, signer):
+        if signer:
+            return {'Authorization': f'Bearer {signer.token()}'}
+        return self.headers
+
+    def _observe(self, signer, status, seconds, retry_after=None):
+        if self.principals and signer is not None:
+            self.principals.observe(signer, status, seconds, retry_after)
+
+    def url(self, path):
+        if path.startswith('http://') or path.startswith('https://'):
+            return path
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    def _record(self, endpoint, seconds=None, retried=False):
+        with self._stats_lock:
+            stats = self._stats.setdefault(endpoint, {'requests': 0, 'retries': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            if retried:
+                stats['retries'] += 1
+            if seconds is not None:
+                stats['requests'] += 1
+                stats['seconds'] += seconds
+                stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+    def _delay(self, attempt, response=None):
+        retry_after = retry_after_seconds(response) if response is not None else None
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0.5, 1.0) * min(self.max_backoff, self.backoff * 2 ** attempt)
+
+    def request(self, method, path, headers=None, authenticated=True, **kwargs):
+        method = method.upper()
+        url = self.url(path)
+        endpoint = endpoint_name(method, url, self.base_url)
+        retry_statuses = RETRY_STATUSES if method in IDEMPOTENT_METHODS else UNPROCESSED_STATUSES
+        kwargs.setdefault('timeout', self.timeout)
+        reauthorized = False
+        attempt = 0
+
+        while True:
+            start_time = time.perf_counter()
+            signer = self._signer(url) if authenticated else None
+            finish = None
+            try:
+                request_headers = {**self._auth_headers(signer), **(headers or {})} if authenticated else dict(headers or {})
+                finish = self.scheduler.acquire(endpoint) if self.scheduler and authenticated else None
+                response = self.session.request(method, url, headers=request_headers, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                seconds = time.perf_counter() - start_time
+                self._record(endpoint, seconds)
+                self._observe(signer, None, seconds)
+                if finish:
+                    finish()
+                if method not in IDEMPOTENT_METHODS or attempt == self.max_retries:
+                    raise
+                delay = self._delay(attempt)
+                logger.warning(f"{endpoint} failed with {type(e).__name__}, retrying in {delay:.1f}s")
+            except BaseException:
+                if finish:
+                    finish()
+                raise
+            else:
+                seconds = time.perf_counter() - start_time
+                self._record(endpoint, seconds)
+                retry_after = retry_after_seconds(response)
+                self._observe(signer, response.status_code, seconds, retry_after)
+                # Another service principal with access to the workspace is not throttled, the retry switches to it right away
+                rerouted = response.status_code == 429 and self.principals and self.principals.available(url)
+                if finish:
+                    # The Retry-After pause holds back the whole endpoint class, unless the retry goes to another principal
+                    finish(response.status_code, None if rerouted else retry_after)
+                if response.status_code == 401 and signer and not reauthorized:
+                    # An expired or revoked token is refreshed once, then the request is sent again
+                    reauthorized = True
+                    signer.refresh(request_headers['Authorization'][len('Bearer '):])
+                    logger.warning(f"{endpoint} returned 401, retrying with a refreshed token")
+                    _rewind(kwargs)
+                    continue
+                if response.status_code not in retry_statuses or attempt == self.max_retries:
+                    response.raise_for_status()
+                    return response
+                delay = self._delay(attempt, response)
+                if rerouted or (finish and response.status_code == 429 and retry_after is not None):
+                    # A rerouted retry goes out right away, otherwise the scheduler already holds it back for Retry-After
+                    delay = 0.0
+                logger.warning(f"{endpoint} returned {response.status_code}, retrying in {delay:.1f}s")
+            self._record(endpoint, retried=True)
+            time.sleep(delay)
+            attempt += 1
+            _rewind(kwargs)
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def stats(self):
+        with self._stats_lock:
+            return {endpoint: dict(stats) for endpoint, stats in self._stats.items()}
+
+    def log_stats(self):
+        for endpoint, stats in sorted(self.stats().items()):
+            average = stats['seconds'] / stats['requests'] if stats['requests'] else 0.0
+            logger.info(f"{endpoint}: {stats['requests']} requests, {stats['retries']} retries, "
+                        f"avg {average:.3f}s, max {stats['max_seconds']:.3f}s")
@@ -0,0 +1,157 @@
+import hashlib
+import json
+import logging
+import threading
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional
+import yaml
+from pydantic import BaseModel, PrivateAttr, ValidationError
+from report_deployer.files import atomic_write
+
+logger = logging.getLogger(__name__)
+
+
+class ConfigError(ValueError):
+    def __init__(self, errors: List[str]):
+        self.errors = errors
+        super().__init__("Invalid deployment configuration:\n" + "\n".join(f"  - {error}" for error in errors))
+
+
+class EnvironmentTarget(BaseModel):
+    workspace: str
+    subfolder: Optional[str] = None
+
+
+class ReportEntry(BaseModel):
+    name: str
+    display_name: Optional[str] = None
+    dataset: str
+    environment: Dict[str, EnvironmentTarget]
+
+    @property
+    def report_name(self):
+        return self.display_name or self.name
+
+
+class DeploymentConfig(BaseModel):
+    reports: List[ReportEntry]
+
+    _by_name: Dict[str, ReportEntry] = PrivateAttr(default_factory=dict)
+    _by_workspace: Dict[tuple, List[ReportEntry]] = PrivateAttr(default_factory=dict)
+
+    def model_post_init(self, __context):
+        by_workspace = defaultdict(list)
+        for report in self.reports:
+            self._by_name.setdefault(report.name, report)
+            for environment, target in report.environment.items():
+                by_workspace[(environment, target.workspace)].append(report)
+        self._by_workspace = dict(by_workspace)
+
+    def report(self, name) -> Optional[ReportEntry]:
+        return self._by_name.get(name)
+
+    def reports_in_workspace(self, environment, workspace) -> List[ReportEntry]:
+        return self._by_workspace.get((environment, workspace), [])
+
+    def environments(self) -> List[str]:
+        return list(dict.fromkeys(environment for environment, _ in self._by_workspace))
+
+    def workspaces(self, environment) -> List[str]:
+        return sorted(workspace for env, workspace in self._by_workspace if env == environment)
+
+
+def _location(raw, loc):
+    prefix = 'config'
+    if len(loc) >= 2 and loc[0] == 'reports' and isinstance(loc[1], int):
+        reports = raw.get('reports') or []
+        entry = reports[loc[1]] if loc[1] < len(reports) else None
+        name = entry.get('name') if isinstance(entry, dict) else None
+        prefix = f"report {name!r}" if name else f"reports[{loc[1]}]"
+        loc = loc[2:]
+    return ' '.join([prefix] + (['.'.join(str(part) for part in loc)] if loc else []))
+
+
+def compile_config(raw) -> DeploymentConfig:
+    if not isinstance(raw, dict):
+        raise ConfigError(["the configuration file must be a mapping with a 'reports' list"])
+    try:
+        config = DeploymentConfig.model_validate(raw)
+    except ValidationError as e:
+        raise ConfigError([f"{_location(raw, error['loc'])}: {error['msg']}" for error in e.errors()]) from None
+
+    seen = defaultdict(int)
+    for report in config.reports:
+        seen[report.name] += 1
+    errors = [f"report {name!r}: defined {count} times" for name, count in seen.items() if count > 1]
+    # Reports published under the same name to one workspace would overwrite each other
+    for environment in config.environments():
+        for workspace in config.workspaces(environment):
+            published = defaultdict(list)
+            for report in config.reports_in_workspace(environment, workspace):
+                published[report.report_name].append(report.name)
+            errors.extend(
+                f"reports {', '.join(map(repr, names))}: all publish {report_name!r} to workspace {workspace!r} in {environment}"
+                for report_name, names in published.items() if len(set(names)) > 1
+            )
+    if errors:
+        raise ConfigError(errors)
+    return config
+
+
+def validate_files(files, config: DeploymentConfig, environments: Optional[List[str]]) -> List[str]:
+    # environments=None deploys every file to all environments its report defines
+    errors = []
+    for file in files:
+        report = config.report(file['file_without_extension'])
+        if not report:
+            errors.append(f"File {file['file_without_extension']} not in the configuration file")
+            continue
+        if environments is None and not report.environment:
+            errors.append(f"No environments defined for {file['file_without_extension']}")
+        for environment in environments or []:
+            if environment not in report.environment:
+                errors.append(f"Environment {environment} not found for {file['file_without_extension']}")
+    return errors
+
+
+def load_config(config_path, cache_dir=None) -> DeploymentConfig:
+    content = Path(config_path).read_bytes()
+    cache_path = None
+    if cache_dir:
+        # The compiled form is keyed by the file's hash and the model's schema, so an edited config, or a
+        # deployer whose config models changed, parses the file again instead of filling in defaults
+        schema = json.dumps(DeploymentConfig.model_json_schema(), sort_keys=True).encode()
+        key = hashlib.sha256(schema + b'\0' + content).hexdigest()
+        cache_path = Path(cache_dir) / f"config-{key}.json"
+        if cache_path.exists():
+            try:
+                return DeploymentConfig.model_validate_json(cache_path.read_bytes())
+            except ValidationError:
+                logger.warning(f"Ignoring unreadable compiled config {cache_path}")
+
+    config = compile_config(yaml.safe_load(content))
+    if cache_path:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with atomic_write(cache_path) as f:
+            f.write(config.model_dump_json())
+    return config
+
+
+class ConfigSource:
+    # Keeps the compiled config of a long-running process and compiles it again when the file changes
+    def __init__(self, config_path, cache_dir=None):
+        self.path = Path(config_path)
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+        self._config = None
+        self._mtime = None
+
+    def get(self) -> DeploymentConfig:
+        mtime = self.path.stat().st_mtime_ns
+        with self._lock:
+            if mtime != self._mtime:
+                self._config = load_config(self.path, self.cache_dir)
+                self._mtime = mtime
+                logger.info(f"Loaded deployment configuration {self.path}")
+            return self._config
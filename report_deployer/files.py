@@ -1,19 +1,35 @@
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, BinaryIO
+import hashlib
+import logging
 import shutil
+import struct
+import tempfile
+import threading
 import zipfile
 import json
 import os
 
+CONNECTIONS_MEMBER = "Connections"
+SPOOL_MAX_SIZE = 64 * 1024 * 1024
+COPY_CHUNK_SIZE = 1024 * 1024
+DATA_DESCRIPTOR_FLAG = 0x08
+
+logger = logging.getLogger(__name__)
+
+def file_info(file) -> dict:
+    return {
+        'name': Path(file).name,
+        'suffix': Path(file).suffix[1:],
+        'file_without_extension': Path(file).stem,
+        'path': Path(file),
+    }
+
 def get_files(files: str, separator: str) -> list:
     files = files.split(separator)
     return [
-        {
-            'name': Path(file).name,
-            'suffix': Path(file).suffix[1:],
-            'file_without_extension': Path(file).stem,
-            'path': Path(file),
-        }
+        file_info(file)
         for file in files
         if Path(file).suffix[1:] in ('rdl', 'pbix')
     ]
@@ -23,6 +39,74 @@ def file_binary(file_path: Path) -> Optional[bytes]:
         raise FileNotFoundError(f"File {file_path} not found")
     return file_path.read_bytes()
 
+def open_file(file_path: Path) -> BinaryIO:
+    if not file_path.exists():
+        raise FileNotFoundError(f"File {file_path} not found")
+    return file_path.open('rb')
+
+class ClosingStream:
+    # A stream that runs a callback once when it is closed, such as releasing what the stream holds
+    def __init__(self, stream: BinaryIO, on_close):
+        self._stream = stream
+        self._on_close = on_close
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._stream.close()
+        if self._on_close is not None:
+            on_close, self._on_close = self._on_close, None
+            on_close()
+
+def file_hash(file_path: Path) -> str:
+    with open_file(file_path) as stream:
+        return stream_hash(stream)
+
+@contextmanager
+def atomic_write(path: Path, mode: str = 'w'):
+    # Written next to the target and renamed over it, so readers never see a partial file.
+    # The temporary file is removed when writing fails.
+    path = Path(path)
+    fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, mode, encoding=None if 'b' in mode else 'utf-8') as output:
+            yield output
+        os.replace(temp_path, path)
+    except BaseException:
+        Path(temp_path).unlink(missing_ok=True)
+        raise
+
+def stream_hash(stream: BinaryIO) -> str:
+    digest = hashlib.sha256()
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(COPY_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+def connections_payload(dataset_id: str) -> dict:
+    return {
+        "Version": 2,
+        "Connections": [
+            {
+                "Name": "EntityDataSource",
+                "ConnectionString": f"Data Source=pbiazure://api.powerbi.com;Initial Catalog={dataset_id};Identity Provider=\"https://login.microsoftonline.com/common, https://analysis.windows.net/powerbi/api, 7f67af8a-fedc-4b08-8b4e-37c4d127b6cf\";Integrated Security=ClaimsToken",
+                "ConnectionType": "pbiServiceLive",
+                "PbiServiceModelId": 0,
+                "PbiModelVirtualServerName": "sobe_wowvirtualserver",
+                "PbiModelDatabaseName": f"{dataset_id}",
+            }
+        ],
+    }
+
 
 def copy_and_unpack_file(file_path: Path, dataset_id: str, workspace: str) -> Optional[bytes]:
     if not file_path.exists() or file_path.suffix != ".pbix":
@@ -39,19 +123,7 @@ def copy_and_unpack_file(file_path: Path, dataset_id: str, workspace: str) -> Op
         with zipfile.ZipFile(zip_path, 'r') as zip_ref:
             zip_ref.extractall(unpack_folder)
 
-        connections_content = {
-            "Version": 2,
-            "Connections": [
-                {
-                    "Name": "EntityDataSource",
-                    "ConnectionString": f"Data Source=pbiazure://api.powerbi.com;Initial Catalog={dataset_id};Identity Provider=\"https://login.microsoftonline.com/common, https://analysis.windows.net/powerbi/api, 7f67af8a-fedc-4b08-8b4e-37c4d127b6cf\";Integrated Security=ClaimsToken",
-                    "ConnectionType": "pbiServiceLive",
-                    "PbiServiceModelId": 0,
-                    "PbiModelVirtualServerName": "sobe_wowvirtualserver",
-                    "PbiModelDatabaseName": f"{dataset_id}",
-                }
-            ],
-        }
+        connections_content = connections_payload(dataset_id)
 
         connections_file = unpack_folder / "Connections"
         if not connections_file.exists():
@@ -77,3 +149,158 @@ def copy_and_unpack_file(file_path: Path, dataset_id: str, workspace: str) -> Op
         shutil.rmtree(temp_folder, ignore_errors=True)
 
 
+def _strip_zip64_extra(extra: bytes) -> bytes:
+    # The zip64 field is re-added by ZipInfo.FileHeader when the sizes need it
+    stripped = b''
+    i = 0
+    while i + 4 <= len(extra):
+        header_id, size = struct.unpack('<HH', extra[i:i + 4])
+        if header_id != 1:
+            stripped += extra[i:i + 4 + size]
+        i += 4 + size
+    return stripped
+
+
+def _copy_raw_member(source: BinaryIO, target: zipfile.ZipFile, info: zipfile.ZipInfo) -> None:
+    source.seek(info.header_offset)
+    header = source.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader or header[:4] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile(f"Bad local file header for {info.filename}")
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    source.seek(name_length + extra_length, os.SEEK_CUR)
+
+    zinfo = zipfile.ZipInfo(info.filename, info.date_time)
+    zinfo.compress_type = info.compress_type
+    zinfo.comment = info.comment
+    zinfo.create_system = info.create_system
+    zinfo.create_version = info.create_version
+    zinfo.extract_version = info.extract_version
+    zinfo.flag_bits = info.flag_bits & ~DATA_DESCRIPTOR_FLAG
+    zinfo.internal_attr = info.internal_attr
+    zinfo.external_attr = info.external_attr
+    zinfo.extra = _strip_zip64_extra(info.extra)
+    zinfo.CRC = info.CRC
+    zinfo.compress_size = info.compress_size
+    zinfo.file_size = info.file_size
+    zinfo.header_offset = target.fp.tell()
+
+    target.fp.write(zinfo.FileHeader())
+    remaining = info.compress_size
+    while remaining:
+        chunk = source.read(min(COPY_CHUNK_SIZE, remaining))
+        if not chunk:
+            raise zipfile.BadZipFile(f"Truncated data for {info.filename}")
+        target.fp.write(chunk)
+        remaining -= len(chunk)
+
+    target.filelist.append(zinfo)
+    target.NameToInfo[zinfo.filename] = zinfo
+    target.start_dir = target.fp.tell()
+
+
+def write_connections(file_path: Path, dataset_id: str, output: BinaryIO) -> None:
+    with file_path.open('rb') as source, zipfile.ZipFile(source, 'r') as source_zip:
+        members = source_zip.infolist()
+        if not any(info.filename == CONNECTIONS_MEMBER for info in members):
+            raise FileNotFoundError(f"Connections file not found in {file_path}")
+
+        with zipfile.ZipFile(output, 'w') as target_zip:
+            for info in members:
+                if info.filename != CONNECTIONS_MEMBER:
+                    _copy_raw_member(source, target_zip, info)
+                    continue
+                connections = zipfile.ZipInfo(CONNECTIONS_MEMBER, info.date_time)
+                connections.compress_type = zipfile.ZIP_DEFLATED
+                connections.external_attr = info.external_attr
+                target_zip.writestr(connections, json.dumps(connections_payload(dataset_id)))
+
+
+class _SpooledArtifact(tempfile.SpooledTemporaryFile):
+    # Python 3.10's SpooledTemporaryFile lacks the io.IOBase checks zipfile and requests make on streams
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def writable(self):
+        return True
+
+
+def rewrite_connections(file_path: Path, dataset_id: str, spool_max_size: int = SPOOL_MAX_SIZE) -> BinaryIO:
+    if not file_path.exists() or file_path.suffix != ".pbix":
+        raise FileNotFoundError(f"File {file_path} not found or not a .pbix file")
+
+    output = _SpooledArtifact(max_size=spool_max_size)
+    try:
+        write_connections(file_path, dataset_id, output)
+        output.seek(0)
+        return output
+    except BaseException:
+        output.close()
+        raise
+
+
+class ArtifactStore:
+    # Rewritten .pbix files shared by deployments of one source file to the same dataset ID that are
+    # in flight at the same time. Each file is deleted when its last handle is closed, so the store
+    # never holds more than the artifacts being uploaded. .rdl files are streamed from the source.
+    def __init__(self, directory=None):
+        self._directory = tempfile.TemporaryDirectory(prefix='report-deployer-', dir=directory)
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._created = 0
+        self.prepared = 0
+        self.reused = 0
+
+    def open(self, file, dataset_id: str) -> BinaryIO:
+        if file['suffix'] != 'pbix':
+            return open_file(file['path'])
+        key = (str(file['path']), dataset_id)
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = {'lock': threading.Lock(), 'path': None, 'handles': 0}
+            entry = self._entries[key]
+            entry['handles'] += 1
+        try:
+            with entry['lock']:
+                if entry['path'] is None:
+                    entry['path'] = self._prepare(file, dataset_id)
+                    with self._lock:
+                        self.prepared += 1
+                else:
+                    with self._lock:
+                        self.reused += 1
+                stream = entry['path'].open('rb')
+        except BaseException:
+            self._release(key)
+            raise
+        return ClosingStream(stream, lambda: self._release(key))
+
+    def _release(self, key):
+        with self._lock:
+            entry = self._entries[key]
+            entry['handles'] -= 1
+            if entry['handles']:
+                return
+            del self._entries[key]
+            if entry['path'] is not None:
+                entry['path'].unlink(missing_ok=True)
+
+    def _prepare(self, file, dataset_id):
+        if not file['path'].exists():
+            raise FileNotFoundError(f"File {file['path']} not found or not a .pbix file")
+        with self._lock:
+            self._created += 1
+            target = Path(self._directory.name) / f"{self._created}.pbix"
+        try:
+            with target.open('wb') as output:
+                write_connections(file['path'], dataset_id, output)
+        except BaseException:
+            target.unlink(missing_ok=True)
+            raise
+        return target
+
+    def close(self) -> None:
+        logger.info(f"Prepared {self.prepared} artifacts, reused {self.reused}")
+        self._directory.cleanup()
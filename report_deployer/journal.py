@@ -0,0 +1,85 @@
+import logging
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Optional
+from pydantic import BaseModel, ValidationError
+
+logger = logging.getLogger(__name__)
+
+PREPARED = 'prepared'
+UPLOADED = 'uploaded'
+RESOLVED = 'resolved'
+DATASOURCE_UPDATED = 'datasource_updated'
+DONE = 'done'
+
+
+class JournalEntry(BaseModel):
+    key: str
+    stage: str
+    source_hash: Optional[str] = None
+    artifact_hash: Optional[str] = None
+    dataset_id: Optional[str] = None
+    workspace_id: Optional[str] = None
+    import_id: Optional[str] = None
+    report_id: Optional[str] = None
+    at: Optional[str] = None
+
+
+class DeploymentJournal:
+    # Append-only JSON lines, one line per stage reached, so a killed run leaves every completed stage behind
+    def __init__(self, path, resume: bool = False):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._entries = self._load() if resume else {}
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = self.path.open('a' if resume else 'w', encoding='utf-8')
+
+    def _load(self):
+        entries = {}
+        if not self.path.exists():
+            return entries
+        with self.path.open('r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = JournalEntry.model_validate_json(line)
+                except ValidationError:
+                    # A run killed mid-write leaves at most one torn line at the end
+                    logger.warning(f"Ignoring unreadable journal line in {self.path}")
+                    continue
+                entries[entry.key] = entry
+        return entries
+
+    @staticmethod
+    def key(environment, report_config):
+        return f"{environment}/{report_config.workspace}/{report_config.report_name}"
+
+    def get(self, environment, report_config) -> Optional[JournalEntry]:
+        with self._lock:
+            return self._entries.get(self.key(environment, report_config))
+
+    def record(self, environment, report_config, stage, source_hash=None, artifact_hash=None) -> None:
+        entry = JournalEntry(
+            key=self.key(environment, report_config),
+            stage=stage,
+            source_hash=source_hash,
+            artifact_hash=artifact_hash,
+            dataset_id=report_config.dataset_id,
+            workspace_id=report_config.workspace_id,
+            import_id=report_config.import_id,
+            report_id=report_config.report_id,
+            at=datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        )
+        with self._lock:
+            self._entries[entry.key] = entry
+            self._file.write(entry.model_dump_json() + '\n')
+            self._file.flush()
+
+    def close(self, completed: bool = False) -> None:
+        with self._lock:
+            self._file.close()
+        if completed:
+            self.path.unlink(missing_ok=True)
+            logger.info(f"All reports deployed, removed journal {self.path}")
+        else:
+            logger.info(f"Journal kept at {self.path}, rerun with --resume to continue")
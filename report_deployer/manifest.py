@@ -0,0 +1,81 @@
+import json
+import logging
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Optional
+from pydantic import BaseModel
+from report_deployer.files import atomic_write
+
+logger = logging.getLogger(__name__)
+
+
+class ManifestEntry(BaseModel):
+    artifact_hash: Optional[str] = None
+    source_hash: Optional[str] = None
+    dataset_id: str = None
+    workspace: str
+    workspace_id: str
+    report_id: str = None
+    deployed_at: str = None
+
+
+class DeploymentManifest:
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._entries = self._load()
+        self._dirty = False
+
+    def _load(self):
+        if not self.path.exists():
+            return {}
+        with self.path.open('r', encoding='utf-8') as f:
+            reports = json.load(f).get('reports', {})
+        return {key: ManifestEntry(**entry) for key, entry in reports.items()}
+
+    @staticmethod
+    def key(environment, workspace, report_name):
+        return f"{environment}/{workspace}/{report_name}"
+
+    def get(self, environment, workspace, report_name) -> Optional[ManifestEntry]:
+        with self._lock:
+            return self._entries.get(self.key(environment, workspace, report_name))
+
+    def unchanged(self, environment, report_config, artifact_hash=None, source_hash=None) -> bool:
+        # A .pbix is rewritten deterministically, so the same source and dataset give the same artifact
+        entry = self.get(environment, report_config.workspace, report_config.report_name)
+        return (
+            entry is not None
+            and (
+                (artifact_hash is not None and entry.artifact_hash == artifact_hash)
+                or (source_hash is not None and entry.source_hash == source_hash)
+            )
+            and entry.dataset_id == report_config.dataset_id
+            and entry.workspace_id == report_config.workspace_id
+        )
+
+    def record(self, environment, report_config, artifact_hash=None, source_hash=None) -> None:
+        entry = ManifestEntry(
+            artifact_hash=artifact_hash,
+            source_hash=source_hash,
+            dataset_id=report_config.dataset_id,
+            workspace=report_config.workspace,
+            workspace_id=report_config.workspace_id,
+            report_id=report_config.report_id,
+            deployed_at=datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        )
+        with self._lock:
+            self._entries[self.key(environment, report_config.workspace, report_config.report_name)] = entry
+            self._dirty = True
+
+    def save(self) -> None:
+        with self._lock:
+            if not self._dirty:
+                return
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with atomic_write(self.path) as f:
+                reports = {key: entry.model_dump() for key, entry in sorted(self._entries.items())}
+                json.dump({'version': 1, 'reports': reports}, f, indent=2)
+            self._dirty = False
+        logger.info(f"Deployment manifest saved to {self.path}")
@@ -0,0 +1,255 @@
+import cProfile
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from report_deployer.pipeline import DeploymentResult
+
+logger = logging.getLogger(__name__)
+
+HOT_STAGES = ('prepare', 'upload', 'poll')
+
+_local = threading.local()
+_current = None
+
+
+class RunReport:
+    def __init__(self, profile_dir=None):
+        self.started_at = datetime.now(timezone.utc)
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self.spans = []
+        self.counters = defaultdict(int)
+        self.shard = None
+        self.scheduler = None
+        self.profile_dir = Path(profile_dir) if profile_dir else None
+        self._profiles = {}
+        self._profiling = threading.Lock()
+        if self.profile_dir:
+            tracemalloc.start()
+
+    @contextmanager
+    def span(self, stage):
+        report = getattr(_local, 'report', None)
+        environment = getattr(_local, 'environment', None)
+        profiler = self._start_profile(stage)
+        memory_before = tracemalloc.get_traced_memory()[0] if self.profile_dir else 0
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            span = {'report': report, 'environment': environment, 'stage': stage, 'seconds': round(seconds, 4)}
+            if self.profile_dir:
+                span['memory_delta'] = tracemalloc.get_traced_memory()[0] - memory_before
+            self._stop_profile(stage, profiler)
+            with self._lock:
+                self.spans.append(span)
+
+    def _start_profile(self, stage):
+        # Only one cProfile profiler can be active per process, concurrent stages are not profiled
+        if not self.profile_dir or stage not in HOT_STAGES or not self._profiling.acquire(blocking=False):
+            return None
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def _stop_profile(self, stage, profiler):
+        if profiler is None:
+            return
+        profiler.disable()
+        self._profiling.release()
+        with self._lock:
+            if stage in self._profiles:
+                self._profiles[stage].add(profiler)
+            else:
+                self._profiles[stage] = pstats.Stats(profiler)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def stage_totals(self):
+        totals = {}
+        with self._lock:
+            for span in self.spans:
+                total = totals.setdefault(span['stage'], {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+                total['count'] += 1
+                total['seconds'] = round(total['seconds'] + span['seconds'], 4)
+                total['max_seconds'] = max(total['max_seconds'], span['seconds'])
+        return totals
+
+    def to_dict(self, results=(), http=None):
+        with self._lock:
+            spans = list(self.spans)
+            counters = dict(self.counters)
+        return {
+            'started_at': self.started_at.isoformat(timespec='seconds'),
+            'seconds': round(time.perf_counter() - self._start, 3),
+            'shard': self.shard,
+            'reports': [result.model_dump() for result in results],
+            'stages': self.stage_totals(),
+            'spans': spans,
+            'counters': counters,
+            'http': http or {},
+            'scheduler': self.scheduler,
+        }
+
+    def write_json(self, path, results=(), http=None):
+        Path(path).write_text(json.dumps(self.to_dict(results, http), indent=2), encoding='utf-8')
+        logger.info(f"Run report written to {path}")
+
+    def write_openmetrics(self, path, results=(), http=None):
+        lines = [
+            '# TYPE report_deployer_stage_seconds summary',
+        ]
+        for stage, total in sorted(self.stage_totals().items()):
+            lines.append(f'report_deployer_stage_seconds_count{{stage="{stage}"}} {total["count"]}')
+            lines.append(f'report_deployer_stage_seconds_sum{{stage="{stage}"}} {total["seconds"]}')
+        # One family per metric, each with its own TYPE line as OpenMetrics requires
+        for family, stat in (('http_requests', 'requests'), ('http_retries', 'retries')):
+            lines.append(f'# TYPE report_deployer_{family} counter')
+            for endpoint, stats in sorted((http or {}).items()):
+                lines.append(f'report_deployer_{family}_total{{endpoint="{endpoint}"}} {stats[stat]}')
+        for name, value in sorted(self.counters.items()):
+            lines.append(f'# TYPE report_deployer_{name} counter')
+            lines.append(f'report_deployer_{name}_total {value}')
+        if self.scheduler:
+            for stat in ('limit', 'rate', 'max_queued'):
+                lines.append(f'# TYPE report_deployer_scheduler_{stat} gauge')
+                for name, stats in sorted(self.scheduler.items()):
+                    lines.append(f'report_deployer_scheduler_{stat}{{class="{name}"}} {stats[stat]}')
+        lines.append('# TYPE report_deployer_reports gauge')
+        for status in ('deployed', 'unchanged', 'failed'):
+            count = sum(1 for result in results if _status(result) == status)
+            lines.append(f'report_deployer_reports{{status="{status}"}} {count}')
+        lines.append('# EOF')
+        Path(path).write_text('\n'.join(lines) + '\n', encoding='utf-8')
+
+    def github_summary(self, results=(), http=None):
+        per_report = defaultdict(dict)
+        with self._lock:
+            for span in self.spans:
+                stages = per_report[span['report'], span['environment']]
+                stages[span['stage']] = stages.get(span['stage'], 0.0) + span['seconds']
+        stages = sorted(self.stage_totals())
+        environments = any(result.environment for result in results)
+        lines = [
+            '### Report deployment',
+            '',
+            '| Report | ' + ('Environment | ' if environments else '') + 'Workspace | Status | ' + ' | '.join(stages) + ' | Total |',
+            '|---|---|' + ('---|' if environments else '') + '---|' + '---:|' * (len(stages) + 1),
+        ]
+        for result in results:
+            timings = ' | '.join(f"{per_report[result.name, result.environment].get(stage, 0.0):.1f}s" for stage in stages)
+            environment = f" {result.environment} |" if environments else ''
+            lines.append(f"| {result.name} |{environment} {result.workspace or ''} | {_status(result)} | {timings} | {result.seconds:.1f}s |")
+        requests = sum(stats['requests'] for stats in (http or {}).values())
+        retries = sum(stats['retries'] for stats in (http or {}).values())
+        lines += [
+            '',
+            f"{requests} HTTP requests, {retries} retries, {self.counters.get('bytes_uploaded', 0) / (1024 * 1024):.1f} MB uploaded "
+            f"in {time.perf_counter() - self._start:.1f}s",
+        ]
+        return '\n'.join(lines) + '\n'
+
+    def write_profiles(self):
+        if not self.profile_dir:
+            return
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        for stage, stats in self._profiles.items():
+            stats.dump_stats(self.profile_dir / f"{stage}.pstats")
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        top = '\n'.join(str(stat) for stat in snapshot.statistics('lineno')[:25])
+        (self.profile_dir / 'tracemalloc.txt').write_text(f"current={current} peak={peak}\n{top}\n", encoding='utf-8')
+        tracemalloc.stop()
+        logger.info(f"Profiles written to {self.profile_dir}")
+
+
+def _status(result):
+    return 'failed' if not result.succeeded else 'unchanged' if result.skipped else 'deployed'
+
+
+def start_run(profile_dir=None):
+    global _current
+    _current = RunReport(profile_dir)
+    return _current
+
+
+def current_run():
+    return _current
+
+
+@contextmanager
+def span(stage):
+    if _current is None:
+        yield
+        return
+    with _current.span(stage):
+        yield
+
+
+def count(name, value=1):
+    if _current is not None:
+        _current.count(name, value)
+
+
+@contextmanager
+def report_context(name, environment=None):
+    previous = getattr(_local, 'report', None), getattr(_local, 'environment', None)
+    _local.report, _local.environment = name, environment
+    try:
+        yield
+    finally:
+        _local.report, _local.environment = previous
+
+
+def merge_run_reports(paths):
+    merged = RunReport()
+    results, http, shards, seconds, started = [], {}, set(), 0.0, []
+    for path in paths:
+        try:
+            data = json.loads(Path(path).read_text(encoding='utf-8'))
+        except (OSError, ValueError) as e:
+            raise ValueError(f"Cannot read run report {path}: {e}") from None
+        results += [DeploymentResult(**result) for result in data.get('reports', [])]
+        merged.spans += data.get('spans', [])
+        for name, value in data.get('counters', {}).items():
+            merged.counters[name] += value
+        for endpoint, stats in data.get('http', {}).items():
+            total = http.setdefault(endpoint, {})
+            for name, value in stats.items():
+                total[name] = max(total.get(name, 0), value) if name.startswith('max_') else total.get(name, 0) + value
+        # Shards run side by side, so the merged run took as long as the slowest one
+        seconds = max(seconds, data.get('seconds', 0.0))
+        if data.get('started_at'):
+            started.append(datetime.fromisoformat(data['started_at']))
+        if data.get('shard'):
+            shards.add(data['shard'])
+    counts = {int(shard.split('/')[1]) for shard in shards}
+    if len(counts) > 1:
+        raise ValueError(f"Run reports come from different shard counts: {', '.join(sorted(shards))}")
+    if counts:
+        count = counts.pop()
+        missing = [f"{index}/{count}" for index in range(1, count + 1) if f"{index}/{count}" not in shards]
+        if missing:
+            raise ValueError(f"Missing run reports for shards {', '.join(missing)}")
+    merged.started_at = min(started, default=merged.started_at)
+    merged._start = time.perf_counter() - seconds
+    logger.info(f"Merged {len(paths)} run reports with {len(results)} deployments")
+    return merged, results, http
+
+
+def write_github_summary(run, results=(), http=None):
+    summary_path = os.getenv('GITHUB_STEP_SUMMARY')
+    if summary_path:
+        with open(summary_path, 'a', encoding='utf-8') as f:
+            f.write(run.github_summary(results, http))
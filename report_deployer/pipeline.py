@@ -0,0 +1,238 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, NamedTuple, Optional
+from pydantic import BaseModel
+from report_deployer.files import ClosingStream
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class DeploymentTask(NamedTuple):
+    name: str
+    workspace: Optional[str]
+    run: Callable[[], Optional[bool]]
+    environment: Optional[str] = None
+    # Index of an earlier task that has to succeed before this one runs
+    after: Optional[int] = None
+
+    @property
+    def label(self):
+        return f"{self.name} [{self.environment}]" if self.environment else self.name
+
+
+class DeploymentResult(BaseModel):
+    name: str
+    workspace: Optional[str] = None
+    environment: Optional[str] = None
+    succeeded: bool = False
+    skipped: bool = False
+    error: Optional[str] = None
+    seconds: float = 0.0
+
+
+class _ReportLogBuffer(logging.Handler):
+    def emit(self, record):
+        records = getattr(_local, 'records', None)
+        if records is not None:
+            records.append(record)
+
+
+def _not_buffered(record):
+    return getattr(_local, 'records', None) is None
+
+
+def log_buffer():
+    # The log block of the report running on this thread, None outside a buffered run
+    return getattr(_local, 'records', None)
+
+
+@contextmanager
+def logging_into(records):
+    # Work done for a report on another thread logs into that report's block
+    previous = getattr(_local, 'records', None)
+    _local.records = records
+    try:
+        yield
+    finally:
+        _local.records = previous
+
+
+class WorkspaceLimiter:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    def __call__(self, workspace):
+        with self._lock:
+            if workspace not in self._semaphores:
+                self._semaphores[workspace] = threading.BoundedSemaphore(self.limit)
+            return self._semaphores[workspace]
+
+
+class ByteBudget:
+    # Caps the bytes of prepared artifacts held at once; one artifact larger than the limit may still run alone
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_flight = 0
+        self.peak = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, size: int) -> None:
+        with self._condition:
+            self._condition.wait_for(lambda: self.in_flight == 0 or self.in_flight + size <= self.limit)
+            self.in_flight += size
+            self.peak = max(self.peak, self.in_flight)
+
+    def release(self, size: int) -> None:
+        with self._condition:
+            self.in_flight -= size
+            self._condition.notify_all()
+
+    def hold(self, stream, size: int):
+        return ClosingStream(stream, lambda: self.release(size))
+
+
+def _run_task(task: DeploymentTask, limiter: WorkspaceLimiter, buffered: bool):
+    records = [] if buffered else None
+    _local.records = records
+    result = DeploymentResult(name=task.name, workspace=task.workspace, environment=task.environment)
+    start_time = time.perf_counter()
+    try:
+        with limiter(task.workspace):
+            result.skipped = bool(task.run())
+        result.succeeded = True
+    except Exception as e:
+        logger.exception(f"Deployment of {task.label} failed")
+        result.error = f"{type(e).__name__}: {e}"
+    finally:
+        result.seconds = round(time.perf_counter() - start_time, 2)
+        _local.records = None
+    return result, records
+
+
+def _gated(task: DeploymentTask, previous: DeploymentTask):
+    return DeploymentResult(
+        name=task.name, workspace=task.workspace, environment=task.environment,
+        error=f"Skipped because {previous.label} did not succeed",
+    )
+
+
+class _Buffering:
+    # Runs may overlap in a long-running process, the first one installs the buffer and the last one removes it
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._runs = 0
+        self._buffer = None
+        self._handlers = []
+
+    def start(self):
+        with self._lock:
+            self._runs += 1
+            if self._runs > 1:
+                return
+            root = logging.getLogger()
+            self._handlers = list(root.handlers)
+            self._buffer = _ReportLogBuffer()
+            for handler in self._handlers:
+                handler.addFilter(_not_buffered)
+            root.addHandler(self._buffer)
+
+    def stop(self):
+        with self._lock:
+            self._runs -= 1
+            if self._runs:
+                return
+            logging.getLogger().removeHandler(self._buffer)
+            for handler in self._handlers:
+                handler.removeFilter(_not_buffered)
+            self._buffer, self._handlers = None, []
+
+
+_buffering = _Buffering()
+
+
+def _flush(records):
+    root = logging.getLogger()
+    for record in records:
+        for handler in root.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+def run_deployments(tasks: List[DeploymentTask], jobs: int = 1, workspace_jobs: int = 1) -> List[DeploymentResult]:
+    limiter = WorkspaceLimiter(workspace_jobs)
+    if jobs <= 1:
+        results = []
+        for task in tasks:
+            if task.after is not None and not results[task.after].succeeded:
+                results.append(_gated(task, tasks[task.after]))
+                logger.error(f"{task.label}: {results[-1].error}")
+            else:
+                results.append(_run_task(task, limiter, buffered=False)[0])
+        return results
+
+    _buffering.start()
+
+    dependents = {}
+    for index, task in enumerate(tasks):
+        if task.after is not None:
+            dependents.setdefault(task.after, []).append(index)
+    futures = [Future() for _ in tasks]
+
+    results = []
+    try:
+        with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='deploy') as executor:
+            def submit(index):
+                executor.submit(_run_task, tasks[index], limiter, True).add_done_callback(lambda done: settle(index, done))
+
+            def settle(index, done):
+                if done.exception() is not None:
+                    futures[index].set_exception(done.exception())
+                else:
+                    finish(index, done.result())
+
+            def finish(index, outcome):
+                # Gated tasks are only queued once the task they wait for has finished
+                for dependent in dependents.get(index, []):
+                    if outcome[0].succeeded:
+                        submit(dependent)
+                    else:
+                        finish(dependent, (_gated(tasks[dependent], tasks[index]), None))
+                futures[index].set_result(outcome)
+
+            for index, task in enumerate(tasks):
+                if task.after is None:
+                    submit(index)
+            # Emit each report's log block in submission order as soon as it is done
+            for task, future in zip(tasks, futures):
+                result, records = future.result()
+                logger.info(f"----- {task.label} -----")
+                if records is None:
+                    logger.error(f"{task.label}: {result.error}")
+                else:
+                    _flush(records)
+                results.append(result)
+    finally:
+        _buffering.stop()
+    return results
+
+
+def log_summary(results: List[DeploymentResult]) -> bool:
+    succeeded = [result for result in results if result.succeeded]
+    failed = [result for result in results if not result.succeeded]
+    skipped = [result for result in succeeded if result.skipped]
+    logger.info(f"Deployment summary: {len(succeeded) - len(skipped)} deployed, {len(skipped)} unchanged, {len(failed)} failed")
+    for result in results:
+        status = "FAILED" if not result.succeeded else "SKIPPED" if result.skipped else "OK"
+        target = f"{result.environment}/{result.workspace}" if result.environment else result.workspace
+        message = f"  {status:<7} {result.name} ({target}) in {result.seconds}s"
+        if result.error:
+            message += f" - {result.error}"
+        (logger.info if result.succeeded else logger.error)(message)
+    return not failed
@@ -0,0 +1,67 @@
+import logging
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import List, Optional
+from pydantic import BaseModel, ValidationError
+from report_deployer.files import atomic_write
+
+logger = logging.getLogger(__name__)
+
+PLAN_VERSION = 1
+
+
+class PlanDriftError(RuntimeError):
+    pass
+
+
+class PlanEntry(BaseModel):
+    name: str
+    path: str
+    suffix: str
+    environment: str
+    workspace: str
+    workspace_id: str
+    dataset: str
+    dataset_id: str
+    subfolder: Optional[str] = None
+    report_name: str
+    import_id: Optional[str] = None
+    existing: bool = False
+    name_conflict: str
+    source_hash: str
+    # Index of the entry in the previous environment that has to succeed first (--promote)
+    after: Optional[int] = None
+
+    @property
+    def action(self):
+        return 'overwrite' if self.existing else 'create'
+
+
+class DeploymentPlan(BaseModel):
+    version: int = PLAN_VERSION
+    created_at: str = None
+    environments: List[str]
+    entries: List[PlanEntry]
+
+    def write(self, path) -> None:
+        path = Path(path)
+        self.created_at = datetime.now(timezone.utc).isoformat(timespec='seconds')
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with atomic_write(path) as f:
+            f.write(self.model_dump_json(indent=2))
+        logger.info(f"Plan with {len(self.entries)} deployments written to {path}")
+
+    @classmethod
+    def load(cls, path) -> 'DeploymentPlan':
+        try:
+            plan = cls.model_validate_json(Path(path).read_bytes())
+        except (OSError, ValidationError) as e:
+            raise ValueError(f"Cannot read deployment plan {path}: {e}") from None
+        if plan.version != PLAN_VERSION:
+            raise ValueError(f"Deployment plan {path} has version {plan.version}, expected {PLAN_VERSION}")
+        return plan
+
+    def log(self) -> None:
+        logger.info(f"Deployment plan: {sum(not entry.existing for entry in self.entries)} to create, {sum(entry.existing for entry in self.entries)} to overwrite")
+        for entry in self.entries:
+            logger.info(f"  {entry.action:<9} {entry.report_name} ({entry.environment}/{entry.workspace}) nameConflict={entry.name_conflict}")
@@ -0,0 +1,125 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future
+from report_deployer.pipeline import log_buffer, logging_into
+from report_deployer.workspace import _iter_collection
+
+logger = logging.getLogger(__name__)
+
+# Settled imports whose timings are kept, a long-running server would otherwise keep them all
+MAX_TIMINGS = 1000
+
+
+class ImportFailedError(Exception):
+    pass
+
+
+class _PendingImport:
+    def __init__(self, workspace_id, import_id, timeout, interval):
+        self.workspace_id = workspace_id
+        self.import_id = import_id
+        self.started = time.monotonic()
+        self.deadline = self.started + timeout
+        self.interval = interval
+        self.next_poll = self.started + interval
+        self.polls = 0
+        self.future = Future()
+        # The poller logs on its own thread, its lines go to the log block of the report waiting here
+        self.records = log_buffer()
+
+
+class ImportPoller:
+    def __init__(self, client, initial_interval=0.5, max_interval=15.0, backoff=1.5):
+        self.client = client
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self._condition = threading.Condition()
+        self._pending = {}
+        self._thread = None
+        self._timings = {}
+
+    def wait(self, workspace_id, import_id, timeout=300):
+        pending = _PendingImport(workspace_id, import_id, timeout, self.initial_interval)
+        with self._condition:
+            self._pending[import_id] = pending
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='import-poller', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return pending.future.result()
+
+    def timings(self):
+        with self._condition:
+            return dict(self._timings)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._pending:
+                    self._thread = None
+                    return
+                now = time.monotonic()
+                due = [pending for pending in self._pending.values() if pending.next_poll <= now or pending.deadline <= now]
+                if not due:
+                    next_poll = min(min(p.next_poll, p.deadline) for p in self._pending.values())
+                    self._condition.wait(next_poll - now)
+                    continue
+                by_workspace = defaultdict(list)
+                for pending in self._pending.values():
+                    by_workspace[pending.workspace_id].append(pending)
+            for workspace_id in {pending.workspace_id for pending in due}:
+                self._poll_workspace(workspace_id, [p for p in due if p.workspace_id == workspace_id], by_workspace[workspace_id])
+
+    def _poll_workspace(self, workspace_id, due, pending_in_workspace):
+        try:
+            if len(pending_in_workspace) > 1:
+                # One list call settles every pending import of the workspace, its pages are followed until all are found
+                wanted = {pending.import_id for pending in pending_in_workspace}
+                states = {}
+                for import_ in _iter_collection(self.client, f"groups/{workspace_id}/imports"):
+                    if import_['id'] in wanted:
+                        states[import_['id']] = import_
+                        if len(states) == len(wanted):
+                            break
+                polled = pending_in_workspace
+            else:
+                states = {due[0].import_id: self.client.get(f"groups/{workspace_id}/imports/{due[0].import_id}").json()}
+                polled = due
+        except Exception as e:
+            for pending in due:
+                self._settle(pending, exception=e)
+            return
+
+        now = time.monotonic()
+        for pending in polled:
+            pending.polls += 1
+            import_data = states.get(pending.import_id)
+            import_state = import_data.get('importState') if import_data else None
+            with logging_into(pending.records):
+                logger.debug(f"Import {pending.import_id} state: {import_state}")
+            if import_state == 'Succeeded':
+                self._settle(pending, result=import_data)
+            elif import_state == 'Failed':
+                self._settle(pending, exception=ImportFailedError(f"Import failed: {import_data.get('error')}"))
+            elif pending.deadline <= now:
+                self._settle(pending, exception=TimeoutError("Timeout while waiting for the import to finish"))
+            else:
+                pending.interval = min(self.max_interval, pending.interval * self.backoff)
+                pending.next_poll = now + pending.interval
+
+    def _settle(self, pending, result=None, exception=None):
+        seconds = round(time.monotonic() - pending.started, 2)
+        with self._condition:
+            self._pending.pop(pending.import_id, None)
+            self._timings[pending.import_id] = seconds
+            if len(self._timings) > MAX_TIMINGS:
+                del self._timings[next(iter(self._timings))]
+        if exception:
+            pending.future.set_exception(exception)
+        else:
+            with logging_into(pending.records):
+                logger.info(f"Import {pending.import_id} ready after {seconds}s ({pending.polls} polls)")
+            pending.future.set_result(result)
@@ -0,0 +1,146 @@
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List
+import yaml
+from report_deployer.auth import TokenProvider
+from report_deployer.workspace import get_workspaces
+
+logger = logging.getLogger(__name__)
+
+GROUP_SEGMENT = re.compile(r'/groups/([0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12})')
+# Weight of the latest response in a principal's recent 429 rate
+THROTTLE_DECAY = 0.2
+# Cooldown after a 429 that came without a Retry-After header
+DEFAULT_COOLDOWN = 5.0
+
+
+def load_principals(path, tenant_id, **provider_args) -> List[TokenProvider]:
+    # Secrets stay in the environment, the file only names the variable holding each one
+    try:
+        entries = yaml.safe_load(Path(path).read_text(encoding='utf-8')) or []
+    except (OSError, yaml.YAMLError) as e:
+        raise ValueError(f"Cannot read service principals from {path}: {e}") from None
+    if not isinstance(entries, list):
+        raise ValueError(f"{path} must contain a list of service principals")
+    providers = []
+    for index, entry in enumerate(entries):
+        secret_env = entry.get('client_secret_env') if isinstance(entry, dict) else None
+        if not secret_env or not entry.get('client_id'):
+            raise ValueError(f"Service principal {index} in {path} needs client_id and client_secret_env")
+        if not os.getenv(secret_env):
+            raise ValueError(f"Environment variable {secret_env} for service principal {entry['client_id']} is not set")
+        providers.append(TokenProvider(entry.get('tenant_id', tenant_id), entry['client_id'], os.getenv(secret_env), **provider_args))
+    return providers
+
+
+class Principal:
+    def __init__(self, provider: TokenProvider):
+        self.provider = provider
+        self.workspaces = set()
+        self.routed = 0
+        self.requests = 0
+        self.throttled = 0
+        self.seconds = 0.0
+        self.throttle_rate = 0.0
+        self.cooldown_until = 0.0
+
+    @property
+    def client_id(self):
+        return self.provider.client_id
+
+    def token(self):
+        return self.provider.token()
+
+    def refresh(self, stale_token):
+        return self.provider.refresh(stale_token)
+
+
+class PrincipalPool:
+    # Picks the service principal for each request: one with access to the workspace in the URL,
+    # not cooling down after a 429, with the lowest recent 429 rate and the fewest requests so far
+    def __init__(self, providers: List[TokenProvider]):
+        self.principals = [Principal(provider) for provider in providers]
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._start = time.monotonic()
+
+    @contextmanager
+    def pinned(self, principal: Principal):
+        self._local.principal = principal
+        try:
+            yield
+        finally:
+            self._local.principal = None
+
+    def _eligible(self, url):
+        match = GROUP_SEGMENT.search(url or '')
+        workspace = match.group(1).lower() if match else None
+        eligible = [principal for principal in self.principals if workspace in principal.workspaces]
+        # Requests outside a workspace, or to one no principal listed, may go to any principal
+        return eligible or self.principals
+
+    def route(self, url) -> Principal:
+        with self._lock:
+            principal = getattr(self._local, 'principal', None)
+            if principal is None:
+                now = time.monotonic()
+                principal = min(
+                    self._eligible(url),
+                    key=lambda candidate: (max(candidate.cooldown_until - now, 0.0), candidate.throttle_rate, candidate.routed),
+                )
+            principal.routed += 1
+            return principal
+
+    def available(self, url) -> bool:
+        if getattr(self._local, 'principal', None) is not None:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            return any(principal.cooldown_until <= now for principal in self._eligible(url))
+
+    def observe(self, principal: Principal, status, seconds, retry_after=None) -> None:
+        throttled = status == 429
+        with self._lock:
+            principal.requests += 1
+            principal.seconds += seconds
+            principal.throttled += throttled
+            principal.throttle_rate += THROTTLE_DECAY * (throttled - principal.throttle_rate)
+            if throttled:
+                cooldown = retry_after if retry_after is not None else DEFAULT_COOLDOWN
+                principal.cooldown_until = max(principal.cooldown_until, time.monotonic() + cooldown)
+
+    def discover(self, client):
+        # Lists the workspaces each principal can see, which assigns every workspace to the principals with access
+        groups = {}
+        for principal in self.principals:
+            with self.pinned(principal):
+                for group in get_workspaces(client):
+                    principal.workspaces.add(group['id'].lower())
+                    groups.setdefault(group['id'], group)
+            logger.info(f"Service principal {principal.client_id} has access to {len(principal.workspaces)} workspaces")
+        return list(groups.values())
+
+    def stats(self):
+        elapsed = max(time.monotonic() - self._start, 1e-9)
+        with self._lock:
+            return {
+                principal.client_id: {
+                    'requests': principal.requests,
+                    'throttled': principal.throttled,
+                    'requests_per_second': round(principal.requests / elapsed, 2),
+                    'seconds': round(principal.seconds, 3),
+                    'workspaces': len(principal.workspaces),
+                }
+                for principal in self.principals
+            }
+
+    def log_stats(self):
+        for client_id, stats in self.stats().items():
+            throttled = stats['throttled'] / stats['requests'] if stats['requests'] else 0.0
+            logger.info(f"Service principal {client_id}: {stats['requests']} requests ({stats['requests_per_second']}/s), "
+                        f"{stats['throttled']} throttled ({throttled:.0%}), {stats['workspaces']} workspaces")
@@ -0,0 +1,141 @@
+import functools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+UPLOAD = 'upload'
+POLL = 'poll'
+METADATA = 'metadata'
+
+# Multiplicative decrease on a 429 or a latency spike
+DECREASE = 0.5
+# A call this many times slower than the class's average latency, and at least this many seconds slower, counts as a spike
+LATENCY_SPIKE = 3.0
+LATENCY_SPIKE_MIN = 0.5
+# Calls averaged before latency spikes are looked for
+LATENCY_WARMUP = 5
+
+
+def endpoint_class(endpoint: str) -> str:
+    method, path = endpoint.split(' ', 1)
+    if method == 'POST' and (path.endswith('/imports') or path.endswith('/createTemporaryUploadLocation')):
+        return UPLOAD
+    if method == 'GET' and '/imports' in path:
+        return POLL
+    return METADATA
+
+
+class AdaptiveLimit:
+    # AIMD on both the number of calls in flight and a token bucket's refill rate. Each success adds
+    # 1/limit to the limit and 1/rate to the rate, about one more call per round of calls and one more
+    # call per second each second. A 429 or a latency spike halves both.
+    def __init__(self, name, limit=2.0, max_limit=32.0, rate=10.0, max_rate=200.0, latency_spikes=True):
+        self.name = name
+        self.limit = limit
+        self.max_limit = max_limit
+        self.rate = rate
+        self.max_rate = max_rate
+        self.latency_spikes = latency_spikes
+        self.tokens = 1.0
+        self.in_flight = 0
+        self.queued = 0
+        self.max_queued = 0
+        self.latency = None
+        self.calls = 0
+        self.throttled = 0
+        self.decreases = 0
+        self._condition = threading.Condition()
+        self._refilled = time.monotonic()
+        self._last_decrease = 0.0
+
+    def _refill(self, now):
+        # The bucket holds at most one second of calls
+        self.tokens = min(max(1.0, self.rate), self.tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def acquire(self) -> float:
+        with self._condition:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+            while True:
+                self._refill(time.monotonic())
+                if self.in_flight < int(self.limit) and self.tokens >= 1.0:
+                    break
+                # Woken by a release, or when the next token is due
+                self._condition.wait((1.0 - self.tokens) / self.rate if self.tokens < 1.0 else None)
+            self.queued -= 1
+            self.tokens -= 1.0
+            self.in_flight += 1
+            return time.monotonic()
+
+    def release(self, started, status=None, retry_after=None) -> None:
+        seconds = time.monotonic() - started
+        with self._condition:
+            self.in_flight -= 1
+            self.calls += 1
+            spike = (
+                self.latency_spikes and status is not None and status < 400 and self.latency is not None
+                and self.calls > LATENCY_WARMUP and seconds > max(LATENCY_SPIKE * self.latency, self.latency + LATENCY_SPIKE_MIN)
+            )
+            if status == 429 or spike:
+                self.throttled += status == 429
+                self._decrease(started, 'HTTP 429' if status == 429 else f"latency {seconds:.2f}s")
+                if retry_after:
+                    # Nothing else of this class goes out before the service said it would accept calls again.
+                    # The debt is taken at the decreased rate, so the next token is due after Retry-After.
+                    self._refill(time.monotonic())
+                    self.tokens = min(self.tokens, 1.0 - retry_after * self.rate)
+            elif status is not None and status < 500:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+                self.rate = min(self.max_rate, self.rate + 1.0 / self.rate)
+                self.latency = seconds if self.latency is None else self.latency + 0.1 * (seconds - self.latency)
+            self._condition.notify_all()
+
+    def _decrease(self, started, reason):
+        # Calls sent before the last decrease saw the old limit, they do not cut it again
+        if started < self._last_decrease:
+            return
+        self._last_decrease = time.monotonic()
+        self.limit = max(1.0, self.limit * DECREASE)
+        self.rate = max(1.0, self.rate * DECREASE)
+        self.decreases += 1
+        logger.info(f"{self.name} calls slowed down after {reason}: {int(self.limit)} concurrent, {self.rate:.1f}/s")
+
+    def stats(self):
+        with self._condition:
+            return {
+                'limit': int(self.limit),
+                'rate': round(self.rate, 1),
+                'in_flight': self.in_flight,
+                'queued': self.queued,
+                'max_queued': self.max_queued,
+                'calls': self.calls,
+                'throttled': self.throttled,
+                'decreases': self.decreases,
+                'latency': round(self.latency, 3) if self.latency is not None else None,
+            }
+
+
+class RequestScheduler:
+    # One adaptive limit per endpoint class, in front of every authenticated Power BI call
+    def __init__(self):
+        self.limits = {
+            # Upload time grows with the file, so slow uploads are not taken as throttling
+            UPLOAD: AdaptiveLimit(UPLOAD, max_limit=16.0, rate=2.0, max_rate=50.0, latency_spikes=False),
+            POLL: AdaptiveLimit(POLL),
+            METADATA: AdaptiveLimit(METADATA),
+        }
+
+    def acquire(self, endpoint):
+        limit = self.limits[endpoint_class(endpoint)]
+        return functools.partial(limit.release, limit.acquire())
+
+    def stats(self):
+        return {name: limit.stats() for name, limit in self.limits.items()}
+
+    def log_stats(self):
+        for name, stats in self.stats().items():
+            logger.info(f"Scheduler {name}: {stats['limit']} concurrent, {stats['rate']}/s, {stats['calls']} calls, "
+                        f"{stats['throttled']} throttled, {stats['decreases']} slowdowns, up to {stats['max_queued']} queued")
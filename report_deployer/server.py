@@ -0,0 +1,205 @@
+import json
+import logging
+import threading
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List, Optional
+from pydantic import BaseModel, Field, ValidationError
+from report_deployer.pipeline import DeploymentResult
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+# Fields a client may set when submitting a job, the rest are filled in by the server
+JOB_REQUEST_FIELDS = {'files', 'separator', 'env', 'promote', 'force', 'dry_run'}
+# Finished jobs kept for status requests
+MAX_FINISHED_JOBS = 1000
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+
+class DeployJob(BaseModel):
+    id: str = Field(default_factory=lambda: uuid.uuid4().hex)
+    files: str
+    separator: str = ','
+    env: str
+    promote: bool = False
+    force: bool = False
+    dry_run: bool = False
+    status: str = QUEUED
+    workspaces: List[str] = []
+    submitted_at: Optional[str] = None
+    started_at: Optional[str] = None
+    finished_at: Optional[str] = None
+    error: Optional[str] = None
+    results: List[DeploymentResult] = []
+
+
+class JobQueue:
+    # Jobs run on a few worker threads. A job waits while an earlier job that shares one of its
+    # target workspaces is queued or running, so deployments into a workspace keep their order.
+    def __init__(self, prepare: Callable, run: Callable, workers: int = 2):
+        self.prepare = prepare
+        self.run = run
+        self._condition = threading.Condition()
+        self._jobs = {}
+        self._queue = []
+        self._busy = set()
+        self._closed = False
+        self._workers = [threading.Thread(target=self._work, name=f"job-{index}", daemon=True) for index in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, payload) -> DeployJob:
+        unknown = set(payload) - JOB_REQUEST_FIELDS
+        if unknown:
+            raise ValueError(f"Unknown job fields: {', '.join(sorted(unknown))}")
+        try:
+            job = DeployJob(**payload, submitted_at=_now())
+        except ValidationError as e:
+            raise ValueError(str(e)) from None
+        # Sets job.workspaces, invalid jobs are rejected here instead of failing in the queue
+        state = self.prepare(job)
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Server is shutting down")
+            self._jobs[job.id] = job
+            self._queue.append((job, state))
+            self._condition.notify_all()
+        logger.info(f"Job {job.id} queued for {', '.join(job.workspaces)}")
+        return job
+
+    def get(self, job_id) -> Optional[DeployJob]:
+        with self._condition:
+            return self._jobs.get(job_id)
+
+    def jobs(self) -> List[DeployJob]:
+        with self._condition:
+            return list(self._jobs.values())
+
+    def _next(self):
+        claimed = set(self._busy)
+        for index, (job, _) in enumerate(self._queue):
+            if claimed.isdisjoint(job.workspaces):
+                return index
+            claimed.update(job.workspaces)
+        return None
+
+    def _work(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._next() is not None or (self._closed and not self._queue))
+                index = self._next()
+                if index is None:
+                    return
+                job, state = self._queue.pop(index)
+                self._busy.update(job.workspaces)
+                job.status, job.started_at = RUNNING, _now()
+            try:
+                job.results = self.run(job, state)
+                job.status = SUCCEEDED if all(result.succeeded for result in job.results) else FAILED
+            except Exception as e:
+                logger.exception(f"Job {job.id} failed")
+                job.status, job.error = FAILED, f"{type(e).__name__}: {e}"
+            finally:
+                job.finished_at = _now()
+                logger.info(f"Job {job.id} {job.status}")
+                with self._condition:
+                    self._busy.difference_update(job.workspaces)
+                    self._forget_finished()
+                    self._condition.notify_all()
+
+    def _forget_finished(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.status in (SUCCEEDED, FAILED)]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+
+    def close(self):
+        # Lets queued jobs finish before returning
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for worker in self._workers:
+            worker.join()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        queue = self.server.queue
+        if self.path == '/health':
+            jobs = queue.jobs()
+            extra = self.server.status() if self.server.status else {}
+            return self._reply(200, {'status': 'ok', 'jobs': {status: sum(job.status == status for job in jobs) for status in (QUEUED, RUNNING, SUCCEEDED, FAILED)}, **extra})
+        if self.path == '/jobs':
+            return self._reply(200, {'jobs': [job.model_dump(include={'id', 'status', 'env', 'submitted_at', 'finished_at'}) for job in queue.jobs()]})
+        if self.path.startswith('/jobs/'):
+            job = queue.get(self.path[len('/jobs/'):])
+            if job is not None:
+                return self._reply(200, job.model_dump())
+        self._reply(404, {'error': f"{self.path} not found"})
+
+    def do_POST(self):
+        if self.path != '/jobs':
+            return self._reply(404, {'error': f"{self.path} not found"})
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if not isinstance(payload, dict):
+                raise ValueError("Expected a JSON object")
+            job = self.server.queue.submit(payload)
+        except (ValueError, OSError) as e:
+            return self._reply(400, {'error': str(e)})
+        except RuntimeError as e:
+            return self._reply(503, {'error': str(e)})
+        self._reply(202, job.model_dump())
+
+
+class DeployServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, queue: JobQueue, on_close: Callable = None, status: Callable = None):
+        super().__init__(address, _Handler)
+        self.queue = queue
+        self.on_close = on_close
+        # Extra fields for /health, such as the request scheduler's limits and queue depths
+        self.status = status
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def run(self):
+        logger.info(f"Accepting deploy jobs on {self.url}")
+        try:
+            self.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        self.server_close()
+        self.queue.close()
+        if self.on_close:
+            self.on_close()
+        logger.info("Deploy server stopped")
@@ -0,0 +1,25 @@
+import logging
+from typing import Dict, Hashable, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    index, _, count = value.partition('/')
+    if not index.isdigit() or not count.isdigit() or not 1 <= int(index) <= int(count):
+        raise ValueError(f"Invalid shard {value!r}, expected INDEX/COUNT with 1 <= INDEX <= COUNT")
+    return int(index), int(count)
+
+
+def assign_shards(sizes: Dict[Hashable, int], count: int) -> Dict[Hashable, int]:
+    # Largest groups first, each onto the least loaded shard. Ties are broken by key and shard number
+    # so every runner computes the same assignment from the same files.
+    loads = [0] * count
+    assignment = {}
+    for key, size in sorted(sizes.items(), key=lambda item: (-item[1], str(item[0]))):
+        shard = min(range(count), key=lambda index: (loads[index], index))
+        assignment[key] = shard + 1
+        loads[shard] += size
+    for index, load in enumerate(loads, start=1):
+        logger.debug(f"Shard {index}/{count}: {load / (1024 * 1024):.1f} MB")
+    return assignment
@@ -0,0 +1,99 @@
+import base64
+import io
+import logging
+import os
+import uuid
+from typing import BinaryIO
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 4 * 1024 * 1024
+READ_SIZE = 64 * 1024
+
+
+def stream_size(stream: BinaryIO) -> int:
+    position = stream.tell()
+    size = stream.seek(0, os.SEEK_END)
+    stream.seek(position)
+    return size - position
+
+
+class MultipartBody:
+    # A multipart/form-data body that reads the file part lazily instead of building it in memory
+    def __init__(self, stream: BinaryIO, field='file', filename='file'):
+        self.boundary = uuid.uuid4().hex
+        head = (
+            f'--{self.boundary}\r\n'
+            f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n\r\n'
+        ).encode()
+        tail = f'\r\n--{self.boundary}--\r\n'.encode()
+        self._stream_start = stream.tell()
+        self._parts = [io.BytesIO(head), stream, io.BytesIO(tail)]
+        self._length = len(head) + stream_size(stream) + len(tail)
+        self._index = 0
+
+    @property
+    def content_type(self):
+        return f'multipart/form-data; boundary={self.boundary}'
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(READ_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if offset != 0 or whence != os.SEEK_SET:
+            raise io.UnsupportedOperation("MultipartBody can only be rewound to the start")
+        self._parts[0].seek(0)
+        self._parts[1].seek(self._stream_start)
+        self._parts[2].seek(0)
+        self._index = 0
+        return 0
+
+    def read(self, size=-1):
+        chunks = []
+        while self._index < len(self._parts) and size != 0:
+            chunk = self._parts[self._index].read(size)
+            if not chunk:
+                self._index += 1
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b''.join(chunks)
+
+
+def upload_blob(client, blob_url: str, stream: BinaryIO, block_size: int = BLOCK_SIZE) -> int:
+    # Azure Blob "Put Block" + "Put Block List" against the SAS URL from createTemporaryUploadLocation
+    separator = '&' if '?' in blob_url else '?'
+    block_ids = []
+    uploaded = 0
+    while True:
+        block = stream.read(block_size)
+        if not block:
+            break
+        block_id = base64.b64encode(f'{len(block_ids):08d}'.encode()).decode()
+        client.request(
+            'PUT',
+            f'{blob_url}{separator}comp=block&blockid={block_id}',
+            data=block,
+            authenticated=False,
+        )
+        block_ids.append(block_id)
+        uploaded += len(block)
+        logger.debug(f"Uploaded block {len(block_ids)} ({uploaded} bytes)")
+
+    block_list = ''.join(f'<Latest>{block_id}</Latest>' for block_id in block_ids)
+    client.request(
+        'PUT',
+        f'{blob_url}{separator}comp=blocklist',
+        data=f'<?xml version="1.0" encoding="utf-8"?><BlockList>{block_list}</BlockList>'.encode(),
+        headers={'Content-Type': 'application/xml'},
+        authenticated=False,
+    )
+    return uploaded
@@ -1,122 +1,136 @@
-import requests
-import re
-
-def get_workspace_id(access_token, workspace_name):
-    url = f'https://api.powerbi.com/v1.0/myorg/groups'
-    response = requests.get(
-        url=url,
-        headers={
-            'Authorization': f'Bearer {access_token}',
-            'Content-Type': 'application/json'
-        }
-    )
-    response.raise_for_status()
-    response_json = response.json()
-    workspace_id = next(workspace['id'] for workspace in response_json['value'] if workspace['name'] == workspace_name)
+import io
+import threading
+from report_deployer.upload import MultipartBody
+
+class NotFoundError(LookupError):
+    pass
+
+
+ADMIN_PAGE_SIZE = 5000
+
+
+def _iter_collection(client, path, params=None, page_size=None):
+    # Pages lazily through @odata.nextLink, or $top/$skip where the endpoint supports it
+    params = dict(params or {})
+    if page_size:
+        params['$top'] = page_size
+    skip = 0
+    while True:
+        payload = client.get(path, params=params or None, headers={'Content-Type': 'application/json'}).json()
+        values = payload['value']
+        yield from values
+        if payload.get('@odata.nextLink'):
+            path, params, page_size = payload['@odata.nextLink'], None, None
+        elif page_size and len(values) == page_size:
+            skip += page_size
+            params['$skip'] = skip
+        else:
+            return
+
+
+def _name_filter(name):
+    escaped = name.replace("'", "''")
+    return {'$filter': f"name eq '{escaped}'"}
+
+
+class _LazyIndex:
+    def __init__(self, items):
+        self._items = iter(items)
+        self._index = {}
+        self._lock = threading.Lock()
+        self.failed = False
+
+    def find(self, *names):
+        # Consumes the underlying pages only until one of the names shows up
+        with self._lock:
+            while True:
+                found = next((self._index[name] for name in names if name in self._index), None)
+                if found is not None:
+                    return found
+                try:
+                    item = next(self._items, None)
+                except Exception:
+                    # A failed page fetch closes the generator, so the resolver builds a new index on the next lookup
+                    self.failed = True
+                    raise
+                if item is None:
+                    return None
+                self._index.setdefault(item['name'], item['id'])
+
+
+def _import_names(import_name):
+    # Imports are named after the uploaded file, with or without its extension
+    return tuple(f"{import_name}{ext}" for ext in ('', '.pbix', '.rdl'))
+
+
+def get_workspaces(client):
+    return _iter_collection(client, 'groups')
+
+def get_workspace_id(client, workspace_name):
+    workspace_id = _LazyIndex(_iter_collection(client, 'groups', _name_filter(workspace_name))).find(workspace_name)
+    if workspace_id is None:
+        raise NotFoundError(f"Workspace {workspace_name} not found or not accessible")
     return workspace_id
 
-def get_dataset_id(access_token, workspace_id, dataset_name):
-    url = f"https://api.powerbi.com/v1.0/myorg/groups/{workspace_id}/datasets"
-    response = requests.get(
-        url=url,
-        headers={
-            'Authorization': f'Bearer {access_token}',
-            'Content-Type': 'application/json'
-        }
-    )
-    response.raise_for_status()
-    dataset_id = next(dataset['id'] for dataset in response.json()['value'] if dataset['name'] == dataset_name)
+def get_dataset_id(client, workspace_id, dataset_name):
+    dataset_id = _LazyIndex(_iter_collection(client, f"groups/{workspace_id}/datasets")).find(dataset_name)
+    if dataset_id is None:
+        raise NotFoundError(f"Dataset {dataset_name} not found in workspace {workspace_id}")
     return dataset_id
 
-def get_report_id(access_token, workspace_id, report_name):
-    url = f"https://api.powerbi.com/v1.0/myorg/groups/{workspace_id}/reports"
-    response = requests.get(
-        url=url,
-        headers={
-            'Authorization': f'Bearer {access_token}',
-            'Content-Type': 'application/json'
-        }
-    )
-    response.raise_for_status()
-    report_id = next(report['id'] for report in response.json()['value'] if report['name'] == report_name)
+def get_report_id(client, workspace_id, report_name):
+    report_id = _LazyIndex(_iter_collection(client, f"groups/{workspace_id}/reports")).find(report_name)
+    if report_id is None:
+        raise NotFoundError(f"Report {report_name} not found in workspace {workspace_id}")
     return report_id
 
-def get_imports(access_token, workspace_id, import_name):
-    url = f"https://api.powerbi.com/v1.0/myorg/groups/{workspace_id}/imports"
-    def import_exists(imports: list, import_name: str) -> bool:
-        extensions = ['', '.pbix', '.rdl']
-        return any(import_['name'] == f"{import_name}{ext}" for ext in extensions for import_ in imports)
-
-    response = requests.get(
-        url=url,
-        headers={
-            'Authorization': f'Bearer {access_token}',
-            'Content-Type': 'application/json'
-        }
-    )
-    response.raise_for_status()
-    imports = response.json()['value']
-
-    # Check if the import exists
-    if import_exists(imports, import_name):
-        import_id = next(import_['id'] for import_ in imports if import_['name'] == import_name or import_['name'] == f"{import_name}.pbix" or import_['name'] == f"{import_name}.rdl")
-    else:
-        import_id = None
-
-    return import_id
-
-def get_import_id(access_token, workspace_id, import_id):
-    url = f"https://api.powerbi.com/v1.0/myorg/groups/{workspace_id}/imports/{import_id}"
-    response = requests.get(
-        url=url,
-        headers={
-            'Authorization': f'Bearer {access_token}'
-        }
-    )
-    response.raise_for_status()
-    return response.json()
+def get_imports(client, workspace_id, import_name):
+    return _LazyIndex(_iter_collection(client, f"groups/{workspace_id}/imports")).find(*_import_names(import_name))
+
+def get_import_id(client, workspace_id, import_id):
+    return client.get(f"groups/{workspace_id}/imports/{import_id}").json()
 
-def post_import(access_token, workspace_id, file, display_name, name_conflict, sub_folder):
-    url = (
-        f'https://api.powerbi.com/v1.0/myorg/groups/{workspace_id}/imports?'
+def _import_path(workspace_id, display_name, name_conflict, sub_folder):
+    return (
+        f'groups/{workspace_id}/imports?'
         f'datasetDisplayName={display_name}'
         f'&nameConflict={name_conflict}{"&subfolderId=" + sub_folder if sub_folder else ""}'
     )
 
-    response = requests.post(
-        url = url,
-        headers={
-            'Authorization': f'Bearer {access_token}'
-        },
-        files={
-            'file': file['binary'],
-        },
+def post_import(client, workspace_id, file, display_name, name_conflict, sub_folder):
+    stream = file['binary']
+    if isinstance(stream, bytes):
+        stream = io.BytesIO(stream)
+    body = MultipartBody(stream)
+    response = client.post(
+        _import_path(workspace_id, display_name, name_conflict, sub_folder),
+        data=body,
+        headers={'Content-Type': body.content_type},
     )
-
-    response.raise_for_status()
     return response.json().get('id')
 
+def create_temporary_upload_location(client, workspace_id):
+    return client.post(f"groups/{workspace_id}/imports/createTemporaryUploadLocation").json()['url']
 
-def get_datasources(access_token, workspace_id, report_id):
-    url = f"https://api.powerbi.com/v1.0/myorg/groups/{workspace_id}/reports/{report_id}/datasources"
-    response = requests.get(
-        url=url,
-        headers={
-            'Authorization': f'Bearer {access_token}'
-        }
+def post_import_from_url(client, workspace_id, file_url, display_name, name_conflict, sub_folder):
+    response = client.post(
+        _import_path(workspace_id, display_name, name_conflict, sub_folder),
+        json={'fileUrl': file_url},
     )
-    response.raise_for_status()
-    return response.json()
-
-def update_datasource(access_token, workspace_id, report_id, data_source_name, dataset_id):
-    url = f"https://api.powerbi.com/v1.0/myorg/groups/{workspace_id}/reports/{report_id}/Default.UpdateDatasources"
-
-    response = requests.post(
-        url=url,
-        headers={
-            'Authorization': f'Bearer {access_token}'
-        },
-                    # 'datasourceName': f"{formatted_string(workspace)}_{formatted_string(dataset)}",
+    return response.json().get('id')
+
+
+def rebind_report(client, workspace_id, report_id, dataset_id):
+    response = client.post(f"groups/{workspace_id}/reports/{report_id}/Rebind", json={'datasetId': dataset_id})
+    return response.status_code
+
+
+def get_datasources(client, workspace_id, report_id):
+    return client.get(f"groups/{workspace_id}/reports/{report_id}/datasources").json()
+
+def update_datasource(client, workspace_id, report_id, data_source_name, dataset_id):
+    response = client.post(
+        f"groups/{workspace_id}/reports/{report_id}/Default.UpdateDatasources",
         json={
             'updateDetails': [
                 {
@@ -130,6 +144,98 @@ def update_datasource(access_token, workspace_id, report_id, data_source_name, d
             ]
         }
     )
-
-    response.raise_for_status()
     return response.status_code
+
+
+class WorkspaceResolver:
+    def __init__(self, client, cache=None, admin_scan=False):
+        self.client = client
+        self.cache = cache
+        self.admin_scan = admin_scan
+        self._lock = threading.Lock()
+        self._indexes = {}
+        self._served_from_cache = set()
+
+    def _index(self, key, items):
+        with self._lock:
+            if key not in self._indexes or self._indexes[key].failed:
+                self._indexes[key] = _LazyIndex(items)
+            return self._indexes[key]
+
+    def _admin_groups(self):
+        # One tenant-wide scan that also fills the dataset and report indexes of every workspace it passes
+        groups = _iter_collection(self.client, 'admin/groups', {'$expand': 'reports,datasets', '$filter': "state eq 'Active'"}, ADMIN_PAGE_SIZE)
+        for group in groups:
+            self._index(('datasets', group['id']), group.get('datasets', []))
+            self._index(('reports', group['id']), group.get('reports', []))
+            yield group
+
+    def _workspace_index(self, workspace_name):
+        if self.admin_scan:
+            return self._index(('groups',), self._admin_groups())
+        return self._index(('groups', workspace_name), _iter_collection(self.client, 'groups', _name_filter(workspace_name)))
+
+    def reset(self, kinds=('imports', 'reports')):
+        # Drops the in-memory lists of these kinds so a long-running process sees reports published since
+        with self._lock:
+            self._indexes = {key: index for key, index in self._indexes.items() if key[0] not in kinds}
+
+    def add_workspaces(self, groups):
+        # Workspaces already listed elsewhere, so their names are not looked up again
+        for group in groups:
+            self._index(('groups', group['name']), [group])
+
+    def _cached(self, kind, *parts):
+        value = self.cache.get(kind, *parts) if self.cache else None
+        if value:
+            self._served_from_cache.add((kind,) + parts)
+        return value
+
+    def _remember(self, kind, *parts, value):
+        if self.cache and value is not None:
+            self.cache.set(kind, *parts, value=value)
+
+    def workspace_id(self, workspace_name):
+        cached = self._cached('workspace', workspace_name)
+        if cached:
+            return cached
+        workspace_id = self._workspace_index(workspace_name).find(workspace_name)
+        if workspace_id is None:
+            raise NotFoundError(f"Workspace {workspace_name} not found or not accessible")
+        self._remember('workspace', workspace_name, value=workspace_id)
+        return workspace_id
+
+    def dataset_id(self, workspace_id, dataset_name):
+        cached = self._cached('dataset', workspace_id, dataset_name)
+        if cached:
+            return cached
+        dataset_id = self._index(('datasets', workspace_id), _iter_collection(self.client, f"groups/{workspace_id}/datasets")).find(dataset_name)
+        if dataset_id is None:
+            raise NotFoundError(f"Dataset {dataset_name} not found in workspace {workspace_id}")
+        self._remember('dataset', workspace_id, dataset_name, value=dataset_id)
+        return dataset_id
+
+    def import_id(self, workspace_id, import_name):
+        # Only existing imports are cached, a report that is missing is looked up again next run
+        cached = self._cached('import', workspace_id, import_name)
+        if cached:
+            return cached
+        index = self._index(('imports', workspace_id), _iter_collection(self.client, f"groups/{workspace_id}/imports"))
+        import_id = index.find(*_import_names(import_name))
+        self._remember('import', workspace_id, import_name, value=import_id)
+        return import_id
+
+    def report_id(self, workspace_id, report_name):
+        return self._index(('reports', workspace_id), _iter_collection(self.client, f"groups/{workspace_id}/reports")).find(report_name)
+
+    def record_import(self, workspace_id, import_name, import_id):
+        self._remember('import', workspace_id, import_name, value=import_id)
+
+    def invalidate(self, workspace_name, workspace_id, dataset_name=None, import_name=None):
+        # Returns True when any of the IDs came from the persistent cache and were dropped
+        keys = [('workspace', workspace_name), ('dataset', workspace_id, dataset_name), ('import', workspace_id, import_name)]
+        stale = [key for key in keys if key in self._served_from_cache]
+        for key in stale:
+            self._served_from_cache.discard(key)
+            self.cache.invalidate(*key)
+        return bool(stale)
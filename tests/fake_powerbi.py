@@ -0,0 +1,313 @@
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+API_PREFIX = '/v1.0/myorg'
+
+
+class FakePowerBI:
+    # In-process stand-in for the Power BI REST API, the AAD token endpoint and SAS blob uploads
+    def __init__(self, latency=0.0, import_delay=0.0, throttle_rate=0.0, failure_rate=0.0, retry_after=1, seed=0, page_size=None):
+        self.page_size = page_size
+        self.latency = latency
+        self.import_delay = import_delay
+        self.throttle_rate = throttle_rate
+        self.failure_rate = failure_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.workspaces = {}
+        self.imports = {}
+        self.uploaded = {}
+        self.blocks = {}
+        self.blobs = {}
+        self.tokens_issued = 0
+        # Service principals are told apart by their token: client ID -> accessible workspace IDs / always throttled
+        self.token_clients = {}
+        self.access = {}
+        self.throttled_clients = set()
+        self.client_requests = Counter()
+        self.statuses = Counter()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _handler(self))
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    @property
+    def api_url(self):
+        return f"{self.url}{API_PREFIX}"
+
+    @property
+    def authority_url(self):
+        return f"{self.url}/login"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add_workspace(self, name, datasets=()):
+        workspace_id = str(uuid.uuid4())
+        with self.lock:
+            self.workspaces[workspace_id] = {
+                'id': workspace_id,
+                'name': name,
+                'datasets': {str(uuid.uuid4()): {'name': dataset} for dataset in datasets},
+                'reports': {},
+            }
+        return workspace_id
+
+    def request_counts(self):
+        with self.lock:
+            return Counter(f"{method} {_template(path)}" for method, path, _ in self.requests)
+
+    def create_import(self, workspace_id, name, content, name_conflict='CreateOrOverwrite'):
+        report_name = name[:-len('.rdl')] if name.endswith('.rdl') else name
+        with self.lock:
+            workspace = self.workspaces.setdefault(workspace_id, {'id': workspace_id, 'name': workspace_id, 'datasets': {}, 'reports': {}})
+            report_id = next((id_ for id_, report in workspace['reports'].items() if report['name'] == report_name), None)
+            if report_id and name_conflict == 'Abort':
+                return None
+            report_id = report_id or str(uuid.uuid4())
+            workspace['reports'][report_id] = {'name': report_name}
+            import_id = str(uuid.uuid4())
+            self.uploaded[import_id] = content
+            self.imports[import_id] = {
+                'id': import_id,
+                'name': name,
+                'workspace_id': workspace_id,
+                'created': time.monotonic(),
+                'reports': [{'id': report_id, 'name': report_name}],
+            }
+        return import_id
+
+    def import_view(self, import_):
+        ready = time.monotonic() - import_['created'] >= self.import_delay
+        return {
+            'id': import_['id'],
+            'name': import_['name'],
+            'importState': 'Succeeded' if ready else 'Publishing',
+            'reports': import_['reports'] if ready else [],
+        }
+
+
+def _template(path):
+    segments = path[len(API_PREFIX):].strip('/').split('/') if path.startswith(API_PREFIX) else path.strip('/').split('/')[:1]
+    return '/' + '/'.join('{id}' if re.fullmatch(r'[0-9a-f-]{36}', segment) else segment for segment in segments)
+
+
+def _filtered(values, query):
+    match = re.fullmatch(r"name eq '((?:[^']|'')*)'", query.get('$filter', [''])[0])
+    if match:
+        values = [value for value in values if value['name'] == match.group(1).replace("''", "'")]
+    skip = int(query.get('$skip', ['0'])[0])
+    top = int(query['$top'][0]) if '$top' in query else None
+    return values[skip:skip + top if top else None]
+
+
+def _multipart_file(body, content_type):
+    boundary = content_type.split('boundary=', 1)[1].encode()
+    part = body.split(b'--' + boundary)[1]
+    return part.split(b'\r\n\r\n', 1)[1][:-2]
+
+
+def _handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def _body(self):
+            return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        def _reply(self, status, payload=None, headers=None):
+            body = json.dumps(payload).encode() if payload is not None else b''
+            with service.lock:
+                service.statuses[status] += 1
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _paged(self, values, query):
+            # Collections without $top support are split into @odata.nextLink pages
+            start = int(query.get('page', ['0'])[0])
+            if not service.page_size or len(values) <= start + service.page_size:
+                return self._reply(200, {'value': values[start:]})
+            next_link = f"{service.url}{urlsplit(self.path).path}?page={start + service.page_size}"
+            self._reply(200, {'value': values[start:start + service.page_size], '@odata.nextLink': next_link})
+
+        def _not_found(self):
+            self._reply(404, {'error': {'code': 'ItemNotFound'}})
+
+        def _dispatch(self, routes):
+            split = urlsplit(self.path)
+            path, query = split.path, parse_qs(split.query)
+            with service.lock:
+                service.requests.append((self.command, path, dict(self.headers)))
+            body = self._body()
+
+            if not path.startswith('/login'):
+                if service.latency:
+                    time.sleep(service.latency)
+                with service.lock:
+                    roll = service.random.random()
+                    client_id = service.token_clients.get(self.headers.get('Authorization', '')[len('Bearer '):])
+                    service.client_requests[client_id] += 1
+                # Throttled principals can still list workspaces, only calls into a workspace return 429
+                throttled = client_id in service.throttled_clients and path.startswith(f'{API_PREFIX}/groups/')
+                if roll < service.throttle_rate or throttled:
+                    return self._reply(429, {'error': {'code': 'TooManyRequests'}}, {'Retry-After': str(service.retry_after)})
+                if roll < service.throttle_rate + service.failure_rate:
+                    return self._reply(500, {'error': {'code': 'InternalServerError'}})
+
+            for pattern, route in routes:
+                match = re.fullmatch(pattern, path)
+                if match:
+                    return route(self, query, body, *match.groups())
+            self._not_found()
+
+        def do_GET(self):
+            self._dispatch(GET_ROUTES)
+
+        def do_POST(self):
+            self._dispatch(POST_ROUTES)
+
+        def do_PUT(self):
+            self._dispatch(PUT_ROUTES)
+
+    def token(handler, query, body):
+        access_token = f'fake-token-{uuid.uuid4()}'
+        with service.lock:
+            service.tokens_issued += 1
+            service.token_clients[access_token] = parse_qs(body.decode()).get('client_id', [None])[0]
+        handler._reply(200, {'token_type': 'Bearer', 'expires_in': 3599, 'access_token': access_token})
+
+    def groups(handler, query, body):
+        with service.lock:
+            client_id = service.token_clients.get(handler.headers.get('Authorization', '')[len('Bearer '):])
+            values = [
+                {'id': id_, 'name': workspace['name']} for id_, workspace in service.workspaces.items()
+                if client_id not in service.access or id_ in service.access[client_id]
+            ]
+        handler._reply(200, {'value': _filtered(values, query)})
+
+    def admin_groups(handler, query, body):
+        with service.lock:
+            values = [
+                {
+                    'id': id_,
+                    'name': workspace['name'],
+                    'state': 'Active',
+                    'datasets': [{'id': item_id, 'name': item['name']} for item_id, item in workspace['datasets'].items()],
+                    'reports': [{'id': item_id, 'name': item['name']} for item_id, item in workspace['reports'].items()],
+                }
+                for id_, workspace in service.workspaces.items()
+            ]
+        handler._reply(200, {'value': _filtered(values, query)})
+
+    def workspace_items(kind):
+        def route(handler, query, body, workspace_id):
+            with service.lock:
+                workspace = service.workspaces.get(workspace_id)
+                values = [{'id': id_, 'name': item['name']} for id_, item in workspace[kind].items()] if workspace else None
+            if values is None:
+                return handler._not_found()
+            handler._paged(values, query)
+        return route
+
+    def imports(handler, query, body, workspace_id):
+        if workspace_id not in service.workspaces:
+            return handler._not_found()
+        with service.lock:
+            values = [service.import_view(import_) for import_ in service.imports.values() if import_['workspace_id'] == workspace_id]
+        handler._paged(values, query)
+
+    def import_(handler, query, body, workspace_id, import_id):
+        with service.lock:
+            found = service.imports.get(import_id)
+            view = service.import_view(found) if found and found['workspace_id'] == workspace_id else None
+        if view is None:
+            return handler._not_found()
+        handler._reply(200, view)
+
+    def datasources(handler, query, body, workspace_id, report_id):
+        handler._reply(200, {'value': [{'name': 'DataSource1', 'datasourceType': 'AnalysisServices'}]})
+
+    def rebind(handler, query, body, workspace_id, report_id):
+        with service.lock:
+            report = service.workspaces.get(workspace_id, {}).get('reports', {}).get(report_id)
+            if report is not None:
+                report['dataset_id'] = json.loads(body)['datasetId']
+        if report is None:
+            return handler._not_found()
+        handler._reply(200)
+
+    def update_datasources(handler, query, body, workspace_id, report_id):
+        handler._reply(200)
+
+    def temporary_upload_location(handler, query, body, workspace_id):
+        handler._reply(200, {'url': f"{service.url}/blob/{uuid.uuid4()}?sv=fake-sas", 'expirationTime': '2099-01-01T00:00:00Z'})
+
+    def post_import(handler, query, body, workspace_id):
+        if workspace_id not in service.workspaces:
+            return handler._not_found()
+        if handler.headers.get('Content-Type', '').startswith('multipart/form-data'):
+            content = _multipart_file(body, handler.headers['Content-Type'])
+        else:
+            blob_id = urlsplit(json.loads(body)['fileUrl']).path.rsplit('/', 1)[1]
+            content = service.blobs[blob_id]
+        name_conflict = query.get('nameConflict', ['CreateOrOverwrite'])[0]
+        import_id = service.create_import(workspace_id, unquote(query['datasetDisplayName'][0]), content, name_conflict)
+        if import_id is None:
+            return handler._reply(409, {'error': {'code': 'DuplicatePackageNameError'}})
+        handler._reply(202, {'id': import_id})
+
+    def put_blob(handler, query, body, blob_id):
+        with service.lock:
+            if query['comp'] == ['block']:
+                service.blocks.setdefault(blob_id, {})[query['blockid'][0]] = body
+            else:
+                block_ids = re.findall(rb'<Latest>([^<]+)</Latest>', body)
+                service.blobs[blob_id] = b''.join(service.blocks[blob_id][block_id.decode()] for block_id in block_ids)
+        handler._reply(201)
+
+    group = rf'{API_PREFIX}/groups/([^/]+)'
+    GET_ROUTES = [
+        (rf'{API_PREFIX}/groups', groups),
+        (rf'{API_PREFIX}/admin/groups', admin_groups),
+        (rf'{group}/datasets', workspace_items('datasets')),
+        (rf'{group}/reports', workspace_items('reports')),
+        (rf'{group}/imports', imports),
+        (rf'{group}/imports/([^/]+)', import_),
+        (rf'{group}/reports/([^/]+)/datasources', datasources),
+    ]
+    POST_ROUTES = [
+        (r'/login/([^/]+)/oauth2/v2\.0/token', lambda handler, query, body, tenant: token(handler, query, body)),
+        (rf'{group}/imports/createTemporaryUploadLocation', temporary_upload_location),
+        (rf'{group}/imports', post_import),
+        (rf'{group}/reports/([^/]+)/Default\.UpdateDatasources', update_datasources),
+        (rf'{group}/reports/([^/]+)/Rebind', rebind),
+    ]
+    PUT_ROUTES = [
+        (r'/blob/([^/]+)', put_blob),
+    ]
+
+    return Handler
@@ -1,8 +1,34 @@
+import io
+import os
+from pathlib import Path
+import json
+import threading
+import logging
+import yaml
+import requests
+import time
+import zipfile
 import pytest
 from unittest.mock import patch, MagicMock
-from report_deployer.auth import authenticate
-from report_deployer.workspace import get_workspace_id, get_dataset_id, get_report_id, post_import
+from report_deployer.auth import authenticate, TokenProvider
+from report_deployer.workspace import get_workspace_id, get_dataset_id, get_report_id, post_import, WorkspaceResolver, NotFoundError
+from report_deployer.app import generate_report_config
+from report_deployer.client import PowerBIClient, endpoint_name, retry_after_seconds
+from report_deployer.polling import ImportPoller, ImportFailedError
+from report_deployer.app import ReportConfig, deploy_report, DeploymentContext, _deploy, skip_unchanged, main
+from report_deployer.manifest import DeploymentManifest
+from report_deployer.upload import MultipartBody
+from tests.fake_powerbi import FakePowerBI
+from report_deployer.cache import MetadataCache, parse_ttls
+from report_deployer.artifacts import ArtifactCache
 from report_deployer.app import parse_arguments
+from report_deployer.files import ArtifactStore, atomic_write, file_info, rewrite_connections, write_connections
+from report_deployer.pipeline import ByteBudget, DeploymentResult, DeploymentTask, run_deployments, log_summary
+from report_deployer.config import ConfigError, ReportEntry, compile_config, load_config, validate_files
+from report_deployer.shard import assign_shards, parse_shard
+from report_deployer.server import JobQueue
+from report_deployer.scheduler import AdaptiveLimit, endpoint_class
+from report_deployer.app import create_server
 
 
 def test_parse_arguments(monkeypatch):
@@ -31,9 +57,12 @@ def setup_mock_response(mock_get, json_data):
     mock_response.raise_for_status = MagicMock()
     mock_get.return_value = mock_response
 
-def assert_mock_get_called_once(mock_get, url, access_token):
+def assert_mock_get_called_once(mock_get, url, access_token, params=None):
     mock_get.assert_called_once_with(
-        url=url,
+        'GET',
+        url,
+        params=params,
+        timeout=300,
         headers={
             'Authorization': f'Bearer {access_token}',
             'Content-Type': 'application/json'
@@ -52,38 +81,984 @@ def test_authenticate(mock_post):
     assert access_token == 'mock_access_token'
     mock_post.assert_called_once()
 
-@patch('requests.get')
+@patch('requests.Session.request')
 def test_get_workspace_id(mock_get):
     setup_mock_response(mock_get, {'value': [{'id': 'workspace_id_123', 'name': 'TestWorkspace'}]})
 
     access_token = 'mock_access_token'
     workspace_name = 'TestWorkspace'
-    workspace_id = get_workspace_id(access_token, workspace_name)
+    workspace_id = get_workspace_id(PowerBIClient(access_token), workspace_name)
 
     assert workspace_id == 'workspace_id_123'
-    assert_mock_get_called_once(mock_get, 'https://api.powerbi.com/v1.0/myorg/groups', access_token)
+    assert_mock_get_called_once(mock_get, 'https://api.powerbi.com/v1.0/myorg/groups', access_token, {'$filter': "name eq 'TestWorkspace'"})
 
-@patch('requests.get')
+@patch('requests.Session.request')
 def test_get_dataset_id(mock_get):
     setup_mock_response(mock_get, {'value': [{'id': 'dataset_id_456', 'name': 'TestDataset'}]})
 
     access_token = 'mock_access_token'
     workspace_id = 'workspace_id_123'
     dataset_name = 'TestDataset'
-    dataset_id = get_dataset_id(access_token, workspace_id, dataset_name)
+    dataset_id = get_dataset_id(PowerBIClient(access_token), workspace_id, dataset_name)
 
     assert dataset_id == 'dataset_id_456'
     assert_mock_get_called_once(mock_get, f'https://api.powerbi.com/v1.0/myorg/groups/{workspace_id}/datasets', access_token)
 
-@patch('requests.get')
+@patch('requests.Session.request')
 def test_get_report_id(mock_get):
     setup_mock_response(mock_get, {'value': [{'id': 'report_id_789', 'name': 'TestReport'}]})
 
     access_token = 'mock_access_token'
     workspace_id = 'workspace_id_123'
     report_name = 'TestReport'
-    report_id = get_report_id(access_token, workspace_id, report_name)
+    report_id = get_report_id(PowerBIClient(access_token), workspace_id, report_name)
 
     assert report_id == 'report_id_789'
     assert_mock_get_called_once(mock_get, f'https://api.powerbi.com/v1.0/myorg/groups/{workspace_id}/reports', access_token)
 
+
+def make_pbix(path, data_model=b'model' * 1000):
+    with zipfile.ZipFile(path, 'w') as pbix:
+        pbix.writestr('Version', 'version', compress_type=zipfile.ZIP_DEFLATED)
+        pbix.writestr('DataModel', data_model, compress_type=zipfile.ZIP_STORED)
+        pbix.writestr('Connections', json.dumps({'Version': 1}), compress_type=zipfile.ZIP_DEFLATED)
+        pbix.writestr('Report/Layout', 'layout' * 100, compress_type=zipfile.ZIP_DEFLATED)
+    return path
+
+
+@pytest.mark.parametrize('spool_max_size', [64 * 1024 * 1024, 1])
+def test_rewrite_connections(tmp_path, spool_max_size):
+    pbix_path = make_pbix(tmp_path / 'report.pbix')
+
+    with rewrite_connections(pbix_path, 'dataset_id_456', spool_max_size) as artifact:
+        assert artifact.seekable() and artifact.readable()
+        with zipfile.ZipFile(artifact) as rewritten, zipfile.ZipFile(pbix_path) as original:
+            assert rewritten.testzip() is None
+            assert rewritten.namelist() == original.namelist()
+            connections = json.loads(rewritten.read('Connections'))
+            assert connections['Connections'][0]['PbiModelDatabaseName'] == 'dataset_id_456'
+            for name in ('Version', 'DataModel', 'Report/Layout'):
+                assert rewritten.read(name) == original.read(name)
+                assert rewritten.getinfo(name).compress_type == original.getinfo(name).compress_type
+                assert rewritten.getinfo(name).compress_size == original.getinfo(name).compress_size
+
+
+def test_artifact_cache_reuses_and_evicts_least_recently_used(tmp_path):
+    file = {'path': make_pbix(tmp_path / 'report.pbix'), 'suffix': 'pbix'}
+    cache = ArtifactCache(tmp_path / 'artifacts', max_size=1)
+
+    with cache.open(file, 'dataset_a') as artifact:
+        first = artifact.read()
+    with rewrite_connections(file['path'], 'dataset_a') as expected:
+        assert first == expected.read()
+    # A single artifact is larger than max_size, so it is evicted once read
+    assert (cache.misses, cache.evictions) == (1, 1)
+
+    cache.max_size = 2 * len(first)
+    with cache.open(file, 'dataset_a'), cache.open(file, 'dataset_b'):
+        pass
+    with patch('report_deployer.artifacts.write_connections') as write:
+        with cache.open(file, 'dataset_a') as artifact:
+            assert artifact.read() == first
+        write.assert_not_called()
+    assert (cache.hits, cache.misses) == (1, 3)
+
+    os.utime(next(cache.directory.glob('*-dataset_a.pbix')), (0, 0))
+    with cache.open(file, 'dataset_c'):
+        pass
+    assert sorted(path.name.split('-', 1)[1] for path in cache.directory.glob('*.pbix')) == ['dataset_b.pbix', 'dataset_c.pbix']
+    assert cache.evictions == 2
+
+
+def test_rewrite_connections_missing_connections(tmp_path):
+    pbix_path = tmp_path / 'report.pbix'
+    with zipfile.ZipFile(pbix_path, 'w') as pbix:
+        pbix.writestr('DataModel', b'model')
+
+    with pytest.raises(FileNotFoundError):
+        rewrite_connections(pbix_path, 'dataset_id_456')
+
+
+def test_run_deployments_collects_results_in_order():
+    def failing():
+        raise RuntimeError('upload failed')
+
+    tasks = [
+        DeploymentTask('slow', 'ws1', lambda: time.sleep(0.05)),
+        DeploymentTask('broken', 'ws2', failing),
+        DeploymentTask('fast', 'ws3', lambda: None),
+    ]
+    results = run_deployments(tasks, jobs=3, workspace_jobs=1)
+
+    assert [result.name for result in results] == ['slow', 'broken', 'fast']
+    assert [result.succeeded for result in results] == [True, False, True]
+    assert results[1].error == 'RuntimeError: upload failed'
+    assert log_summary(results) is False
+
+
+@pytest.mark.parametrize('jobs', [1, 3])
+def test_run_deployments_gates_promoted_environments(jobs):
+    def failing():
+        raise RuntimeError('upload failed')
+
+    ran = []
+    tasks = [
+        DeploymentTask('sales', 'dev-ws', lambda: ran.append('sales dev'), 'dev'),
+        DeploymentTask('finance', 'dev-ws', failing, 'dev'),
+        DeploymentTask('sales', 'prd-ws', lambda: ran.append('sales prd'), 'prd', after=0),
+        DeploymentTask('finance', 'prd-ws', lambda: ran.append('finance prd'), 'prd', after=1),
+    ]
+    results = run_deployments(tasks, jobs=jobs, workspace_jobs=1)
+
+    assert sorted(ran) == ['sales dev', 'sales prd']
+    assert [(result.name, result.environment, result.succeeded) for result in results] == [
+        ('sales', 'dev', True), ('finance', 'dev', False), ('sales', 'prd', True), ('finance', 'prd', False),
+    ]
+    assert results[3].error == 'Skipped because finance [dev] did not succeed'
+
+
+def test_byte_budget_holds_preparation_until_uploads_release():
+    budget = ByteBudget(100)
+    budget.acquire(60)
+    artifact = budget.hold(io.BytesIO(b'artifact'), 60)
+    assert artifact.read() == b'artifact'
+
+    acquired = threading.Event()
+    waiter = threading.Thread(target=lambda: (budget.acquire(60), acquired.set()))
+    waiter.start()
+    assert not acquired.wait(0.1)
+    artifact.close()
+    assert acquired.wait(1)
+    waiter.join()
+    artifact.close()
+    assert budget.in_flight == 60
+
+    # An artifact over the limit still runs once nothing else is in flight
+    budget.release(60)
+    budget.acquire(500)
+    assert budget.peak == 500
+
+
+def test_failed_deployment_releases_the_byte_budget(tmp_path):
+    budget = ByteBudget(100)
+    context = DeploymentContext.model_construct(environment='dev', manifest=MagicMock(), budget=budget)
+    file = file_info(make_pbix(tmp_path / 'sales.pbix'))
+    report = ReportConfig(report_name='Sales', workspace='ws', workspace_id='ws-id', dataset='Sales', dataset_id='ds-id')
+    with patch('report_deployer.app.stream_hash', side_effect=OSError('disk full')):
+        with pytest.raises(OSError):
+            _deploy(context, file, report)
+    assert 'binary' not in file
+    assert budget.in_flight == 0
+
+
+def test_run_deployments_caps_workspace_concurrency():
+    lock = threading.Lock()
+    running = {'ws1': 0}
+    peak = {'ws1': 0}
+
+    def deploy():
+        with lock:
+            running['ws1'] += 1
+            peak['ws1'] = max(peak['ws1'], running['ws1'])
+        time.sleep(0.02)
+        with lock:
+            running['ws1'] -= 1
+
+    tasks = [DeploymentTask(f'report{i}', 'ws1', deploy) for i in range(6)]
+    results = run_deployments(tasks, jobs=6, workspace_jobs=2)
+
+    assert all(result.succeeded for result in results)
+    assert peak['ws1'] == 2
+
+
+def fake_collections(method, url, **kwargs):
+    collections = {
+        'https://api.powerbi.com/v1.0/myorg/groups': [{'id': 'workspace_id_123', 'name': 'TestWorkspace'}],
+        'https://api.powerbi.com/v1.0/myorg/groups/workspace_id_123/datasets': [{'id': 'dataset_id_456', 'name': 'TestDataset'}],
+        'https://api.powerbi.com/v1.0/myorg/groups/workspace_id_123/imports': [{'id': 'import_id_1', 'name': 'report1.pbix'}],
+    }
+    return MagicMock(json=MagicMock(return_value={'value': collections[url]}), raise_for_status=MagicMock())
+
+
+@patch('requests.Session.request', side_effect=fake_collections)
+def test_resolver_fetches_each_collection_once(mock_get):
+    resolver = WorkspaceResolver(PowerBIClient('mock_access_token'))
+    config = {'dataset': 'TestDataset', 'environment': {'dev': {'workspace': 'TestWorkspace'}}}
+
+    reports = [generate_report_config(resolver.client, 'TestWorkspace', ReportEntry(name=name, **config), 'dev', resolver) for name in ('report1', 'report2', 'report3')]
+
+    assert mock_get.call_count == 3
+    assert [report.existing for report in reports] == [True, False, False]
+    assert reports[0].import_id == 'import_id_1'
+    assert all(report.dataset_id == 'dataset_id_456' for report in reports)
+
+
+@patch('requests.Session.request', side_effect=fake_collections)
+def test_resolver_unknown_names(mock_get):
+    resolver = WorkspaceResolver(PowerBIClient('mock_access_token'))
+
+    with pytest.raises(NotFoundError, match='Workspace Missing not found'):
+        resolver.workspace_id('Missing')
+    with pytest.raises(NotFoundError, match='Dataset Missing not found in workspace workspace_id_123'):
+        resolver.dataset_id('workspace_id_123', 'Missing')
+
+
+@patch('requests.Session.request', side_effect=fake_collections)
+def test_resolver_warm_cache_makes_no_lookups(mock_get, tmp_path):
+    cache_path = tmp_path / 'metadata.json'
+    cold = WorkspaceResolver(PowerBIClient('mock_access_token'), MetadataCache(cache_path))
+    workspace_id = cold.workspace_id('TestWorkspace')
+    cold.dataset_id(workspace_id, 'TestDataset')
+    cold.import_id(workspace_id, 'report1')
+    cold.cache.save()
+    assert mock_get.call_count == 3
+
+    warm = WorkspaceResolver(PowerBIClient('mock_access_token'), MetadataCache(cache_path))
+    assert warm.workspace_id('TestWorkspace') == 'workspace_id_123'
+    assert warm.dataset_id('workspace_id_123', 'TestDataset') == 'dataset_id_456'
+    assert warm.import_id('workspace_id_123', 'report1') == 'import_id_1'
+    assert mock_get.call_count == 3
+
+    assert warm.invalidate('TestWorkspace', 'workspace_id_123', 'TestDataset', 'report1') is True
+    assert warm.cache.get('workspace', 'TestWorkspace') is None
+
+
+def test_metadata_cache_ttl_and_refresh(tmp_path):
+    cache_path = tmp_path / 'metadata.json'
+    cache = MetadataCache(cache_path, parse_ttls(['dataset=0']))
+    cache.set('workspace', 'TestWorkspace', value='workspace_id_123')
+    cache.set('dataset', 'workspace_id_123', 'TestDataset', value='dataset_id_456')
+    cache.save()
+
+    reloaded = MetadataCache(cache_path, parse_ttls(['dataset=0']))
+    assert reloaded.get('workspace', 'TestWorkspace') == 'workspace_id_123'
+    assert reloaded.get('dataset', 'workspace_id_123', 'TestDataset') is None
+    assert MetadataCache(cache_path, refresh=True).get('workspace', 'TestWorkspace') is None
+    with pytest.raises(ValueError):
+        parse_ttls(['subfolder=abc'])
+
+
+def http_response(status_code, json_data=None, headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    response._content = json.dumps(json_data or {}).encode()
+    return response
+
+
+@patch('time.sleep')
+@patch('requests.Session.request')
+def test_client_retries_throttled_requests(mock_request, mock_sleep):
+    mock_request.side_effect = [
+        http_response(429, headers={'Retry-After': '7'}),
+        http_response(503),
+        http_response(200, {'value': []}),
+    ]
+    client = PowerBIClient('mock_access_token', backoff=0.1)
+
+    assert client.get('groups').json() == {'value': []}
+    assert mock_sleep.call_args_list[0].args == (7.0,)
+    assert 0.05 <= mock_sleep.call_args_list[1].args[0] <= 0.2
+    assert client.stats()['GET /groups']['requests'] == 3
+    assert client.stats()['GET /groups']['retries'] == 2
+    assert mock_request.call_args.kwargs['headers'] == {'Authorization': 'Bearer mock_access_token'}
+
+
+@patch('time.sleep')
+@patch('requests.Session.request')
+def test_client_does_not_retry_failed_posts(mock_request, mock_sleep):
+    mock_request.return_value = http_response(500)
+    client = PowerBIClient('mock_access_token')
+
+    with pytest.raises(requests.HTTPError):
+        client.post('groups/workspace_id_123/imports', files={'file': b'data'})
+    assert mock_request.call_count == 1
+    mock_sleep.assert_not_called()
+
+
+def test_endpoint_name_and_retry_after():
+    url = 'https://api.powerbi.com/v1.0/myorg/groups/8a1b2c3d-1111-2222-3333-444455556666/imports?nameConflict=Abort'
+    assert endpoint_name('POST', url) == 'POST /groups/{id}/imports'
+    assert retry_after_seconds(http_response(429, headers={'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})) == 0.0
+    assert retry_after_seconds(http_response(429)) is None
+
+
+class FakeImportsClient:
+    def __init__(self, states, page_size=None):
+        self.states = states
+        self.page_size = page_size
+        self.paths = []
+
+    def get(self, path, **kwargs):
+        self.paths.append(path)
+        imports = [{'id': import_id, 'importState': next(states, 'Succeeded'), 'reports': [{'id': f'report_{import_id}'}]}
+                   for import_id, states in self.states.items()]
+        path, _, page = path.partition('?page=')
+        if path.endswith('/imports'):
+            start = int(page or 0)
+            if not self.page_size or len(imports) <= start + self.page_size:
+                return MagicMock(json=MagicMock(return_value={'value': imports[start:]}))
+            next_link = f"{path}?page={start + self.page_size}"
+            return MagicMock(json=MagicMock(return_value={'value': imports[start:start + self.page_size], '@odata.nextLink': next_link}))
+        import_id = path.rsplit('/', 1)[1]
+        return MagicMock(json=MagicMock(return_value=next(i for i in imports if i['id'] == import_id)))
+
+
+@pytest.mark.parametrize('page_size', [None, 1])
+def test_import_poller_settles_pending_imports_with_one_list_call(page_size):
+    client = FakeImportsClient({
+        'import_1': iter(['Publishing', 'Publishing', 'Publishing', 'Succeeded']),
+        'import_2': iter(['Publishing', 'Failed']),
+    }, page_size)
+    poller = ImportPoller(client, initial_interval=0.01, max_interval=0.05)
+    results = {}
+
+    def wait(import_id):
+        try:
+            results[import_id] = poller.wait('ws1', import_id, timeout=5)
+        except ImportFailedError as e:
+            results[import_id] = e
+
+    threads = [threading.Thread(target=wait, args=(import_id,)) for import_id in ('import_1', 'import_2')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results['import_1']['reports'] == [{'id': 'report_import_1'}]
+    assert isinstance(results['import_2'], ImportFailedError)
+    assert set(poller.timings()) == {'import_1', 'import_2'}
+    assert 'groups/ws1/imports' in client.paths
+    assert ('groups/ws1/imports?page=1' in client.paths) is bool(page_size)
+
+
+def test_import_poller_times_out():
+    client = FakeImportsClient({'import_1': iter(['Publishing'] * 100)})
+    poller = ImportPoller(client, initial_interval=0.01, max_interval=0.02)
+
+    with pytest.raises(TimeoutError):
+        poller.wait('ws1', 'import_1', timeout=0.1)
+    assert client.paths[0] == 'groups/ws1/imports/import_1'
+
+
+def test_import_poller_logs_into_each_report_block_and_caps_timings(monkeypatch, caplog):
+    caplog.set_level(logging.INFO)
+    monkeypatch.setattr('report_deployer.polling.MAX_TIMINGS', 1)
+    client = FakeImportsClient({'import_1': iter(['Publishing', 'Succeeded']), 'import_2': iter(['Publishing', 'Succeeded'])})
+    poller = ImportPoller(client, initial_interval=0.01, max_interval=0.02)
+    tasks = [DeploymentTask(import_id, import_id, lambda import_id=import_id: poller.wait('ws1', import_id, timeout=5) and None)
+             for import_id in ('import_1', 'import_2')]
+
+    assert all(result.succeeded for result in run_deployments(tasks, jobs=2))
+    messages = [message for message in caplog.messages if message.startswith(('-----', 'Import'))]
+    assert messages[0] == '----- import_1 -----' and messages[1].startswith('Import import_1 ready')
+    assert messages[2] == '----- import_2 -----' and messages[3].startswith('Import import_2 ready')
+    assert len(poller.timings()) == 1
+
+
+def test_multipart_body_streams_and_rewinds():
+    body = MultipartBody(io.BytesIO(b'x' * 100000))
+    first = b''.join(body)
+    body.seek(0)
+
+    assert len(first) == len(body)
+    assert body.read() == first
+    assert first.startswith(f'--{body.boundary}\r\n'.encode())
+    assert first.endswith(f'\r\n--{body.boundary}--\r\n'.encode())
+
+
+@pytest.mark.parametrize('threshold, expect_blob', [(10 * 1024 * 1024, False), (1024, True)])
+def test_deploy_report_upload_paths(tmp_path, threshold, expect_blob):
+    pbix_path = make_pbix(tmp_path / 'report.pbix', data_model=b'model' * 100000)
+    with FakePowerBI() as service, rewrite_connections(pbix_path, 'dataset_id_456') as artifact:
+        report_config = ReportConfig(workspace='TestWorkspace', workspace_id=service.add_workspace('TestWorkspace'), report_name='report')
+        client = PowerBIClient('mock_access_token', base_url=service.api_url)
+        file = {'name': 'report.pbix', 'suffix': 'pbix', 'binary': artifact}
+        import_id = deploy_report(client, file, report_config, large_file_threshold=threshold)
+
+        artifact.seek(0)
+        assert service.uploaded[import_id] == artifact.read()
+        blob_requests = [request for request in service.requests if request[1].startswith('/blob/')]
+        assert bool(blob_requests) is expect_blob
+        assert all('Authorization' not in headers for _, _, headers in blob_requests)
+
+
+def make_context(**kwargs):
+    client = PowerBIClient('mock_access_token')
+    return DeploymentContext(client=client, resolver=WorkspaceResolver(client), poller=ImportPoller(client), environment='dev', **kwargs)
+
+
+def test_manifest_skips_unchanged_artifacts(tmp_path):
+    pbix_path = make_pbix(tmp_path / 'report.pbix')
+    manifest_path = tmp_path / 'manifest.json'
+    report = ReportConfig(workspace='TestWorkspace', workspace_id='workspace_id_123', dataset_id='dataset_id_456', report_name='report', report_id='report_id_789')
+    file = {'name': 'report.pbix', 'suffix': 'pbix', 'path': pbix_path}
+
+    context = make_context(manifest=DeploymentManifest(manifest_path))
+    assert skip_unchanged(context, file, report) is False
+    context.manifest.record('dev', report, file.pop('artifact_hash'))
+    file.pop('binary').close()
+    context.manifest.save()
+
+    context = make_context(manifest=DeploymentManifest(manifest_path))
+    assert skip_unchanged(context, file, report.model_copy(update={'report_id': None})) is True
+    assert 'binary' not in file
+    assert skip_unchanged(make_context(manifest=context.manifest, force=True), file, report) is False
+    file.pop('binary').close()
+    assert skip_unchanged(context, file, report.model_copy(update={'dataset_id': 'other_dataset'})) is False
+    file.pop('binary').close()
+
+
+def token_response(access_token, expires_in=3600):
+    return MagicMock(json=MagicMock(return_value={'access_token': access_token, 'expires_in': expires_in}), raise_for_status=MagicMock())
+
+
+@patch('requests.post')
+def test_token_provider_refreshes_ahead_of_expiry(mock_post):
+    mock_post.side_effect = [token_response('token_1', expires_in=3600), token_response('token_2')]
+    provider = TokenProvider('mock_tenant_id', 'mock_client_id', 'mock_client_secret', refresh_margin=300)
+
+    assert provider.token() == 'token_1'
+    assert provider.token() == 'token_1'
+    with patch('time.time', return_value=time.time() + 3400):
+        assert provider.token() == 'token_2'
+    assert mock_post.call_count == 2
+
+
+@patch('requests.post')
+def test_token_provider_shares_file_cache(mock_post, tmp_path):
+    mock_post.side_effect = [token_response('token_1'), token_response('token_2')]
+    cache_file = tmp_path / 'tokens.json'
+
+    first = TokenProvider('mock_tenant_id', 'mock_client_id', 'mock_client_secret', cache_file=cache_file)
+    second = TokenProvider('mock_tenant_id', 'mock_client_id', 'mock_client_secret', cache_file=cache_file)
+
+    assert first.token() == 'token_1'
+    assert second.token() == 'token_1'
+    assert mock_post.call_count == 1
+    assert second.refresh('token_1') == 'token_2'
+    assert second.refresh('token_1') == 'token_2'
+    assert mock_post.call_count == 2
+    assert cache_file.stat().st_mode & 0o777 == 0o600
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['tokens.json', 'tokens.json.lock']
+
+
+@patch('requests.post')
+@patch('requests.Session.request')
+def test_client_refreshes_token_once_on_401(mock_request, mock_post):
+    mock_post.side_effect = [token_response('token_1'), token_response('token_2')]
+    mock_request.side_effect = [http_response(401), http_response(200, {'value': []})]
+    client = PowerBIClient(token_provider=TokenProvider('mock_tenant_id', 'mock_client_id', 'mock_client_secret'))
+
+    assert client.get('groups').json() == {'value': []}
+    assert [call.kwargs['headers']['Authorization'] for call in mock_request.call_args_list] == ['Bearer token_1', 'Bearer token_2']
+
+
+def run_main(monkeypatch, service, tmp_path, files, *args, environments=None, dataset='Sales'):
+    environments = environments or {'dev': {'workspace': 'TestWorkspace'}}
+    config = {'reports': [
+        {'name': Path(file).stem, 'dataset': dataset, 'environment': environments}
+        for file in files
+    ]}
+    config_path = tmp_path / 'config.yaml'
+    config_path.write_text(yaml.safe_dump(config))
+    for name, value in {'TENANT_ID': 'tenant', 'CLIENT_ID': 'client', 'CLIENT_SECRET': 'secret',
+                        'POWERBI_API_URL': service.api_url, 'POWERBI_AUTHORITY_URL': service.authority_url}.items():
+        monkeypatch.setenv(name, value)
+    env = [] if '--env' in args else ['--env', 'dev']
+    monkeypatch.setattr('sys.argv', ['app.py', '--config', str(config_path), '--files', ','.join(map(str, files)), *env, *args])
+    main()
+
+
+def test_main_deploys_against_fake_service(monkeypatch, tmp_path):
+    pbix_path = make_pbix(tmp_path / 'sales.pbix')
+    rdl_path = tmp_path / 'invoice.rdl'
+    rdl_path.write_text('<Report/>')
+
+    with FakePowerBI(import_delay=0.2) as service:
+        service.add_workspace('TestWorkspace', datasets=['Sales'])
+        run_main(monkeypatch, service, tmp_path, [pbix_path, rdl_path], '--jobs', '2', '--poll-interval', '0.05')
+
+        counts = service.request_counts()
+        assert sorted(import_['name'] for import_ in service.imports.values()) == ['invoice.rdl', 'sales']
+        assert counts['GET /groups'] == 1
+        assert counts['GET /groups/{id}/datasets'] == 1
+        assert counts['POST /groups/{id}/reports/{id}/Default.UpdateDatasources'] == 1
+        assert service.tokens_issued == 1
+
+
+def test_main_fans_out_to_every_environment(monkeypatch, tmp_path):
+    pbix_path = make_pbix(tmp_path / 'sales.pbix')
+    rdl_path = tmp_path / 'invoice.rdl'
+    rdl_path.write_text('<Report/>')
+    environments = {'dev': {'workspace': 'Dev'}, 'uat': {'workspace': 'Uat'}, 'prd': {'workspace': 'Prd'}}
+
+    with FakePowerBI() as service:
+        dev_id = service.add_workspace('Dev', datasets=['Sales'])
+        uat_id = service.add_workspace('Uat', datasets=['Sales'])
+        prd_id = service.add_workspace('Prd', datasets=['Sales'])
+        with patch('report_deployer.files.write_connections', wraps=write_connections) as rewrite:
+            run_main(monkeypatch, service, tmp_path, [pbix_path, rdl_path], '--env', 'all', '--promote', '--max-in-flight', '1',
+                     '--jobs', '4', '--poll-interval', '0.05', environments=environments)
+
+        assert sorted((import_['workspace_id'], import_['name']) for import_ in service.imports.values()) == sorted(
+            (workspace_id, name) for workspace_id in (dev_id, uat_id, prd_id) for name in ('sales', 'invoice.rdl')
+        )
+        # Every workspace has its own Sales dataset, so the .pbix is rewritten once per dataset ID
+        assert rewrite.call_count == 3
+        assert service.tokens_issued == 1
+
+
+def test_atomic_write_replaces_the_file_or_leaves_it_untouched(tmp_path):
+    path = tmp_path / 'state.json'
+    with atomic_write(path) as f:
+        f.write('{"version": 1}')
+    with pytest.raises(ValueError):
+        with atomic_write(path) as f:
+            f.write('{"vers')
+            raise ValueError('serialization failed')
+    assert path.read_text() == '{"version": 1}'
+    assert [child.name for child in tmp_path.iterdir()] == ['state.json']
+
+
+def test_artifact_store_deletes_artifacts_after_their_last_handle(tmp_path):
+    file = file_info(make_pbix(tmp_path / 'sales.pbix'))
+    store = ArtifactStore(tmp_path)
+    first, second = store.open(file, 'dataset_a'), store.open(file, 'dataset_a')
+    assert (store.prepared, store.reused) == (1, 1)
+    directory = next(tmp_path.glob('report-deployer-*'))
+    first.close()
+    assert len(list(directory.iterdir())) == 1
+    assert second.read(4) == b'PK\x03\x04'
+    second.close()
+    assert list(directory.iterdir()) == []
+    store.open(file, 'dataset_a').close()
+    assert store.prepared == 2
+    store.close()
+
+
+def test_main_rebinds_unchanged_reports_to_a_new_dataset(monkeypatch, tmp_path):
+    pbix_path = make_pbix(tmp_path / 'sales.pbix')
+    manifest_path = tmp_path / 'manifest.json'
+    args = ('--manifest', str(manifest_path), '--rebind', '--poll-interval', '0.05')
+
+    with FakePowerBI() as service:
+        workspace_id = service.add_workspace('TestWorkspace', datasets=['Sales', 'Sales v2'])
+        run_main(monkeypatch, service, tmp_path, [pbix_path], *args)
+        assert len(service.imports) == 1
+
+        run_main(monkeypatch, service, tmp_path, [pbix_path], *args, dataset='Sales v2')
+        run_main(monkeypatch, service, tmp_path, [pbix_path], *args, dataset='Sales v2')
+
+        counts = service.request_counts()
+        report = next(iter(service.workspaces[workspace_id]['reports'].values()))
+        entry = DeploymentManifest(manifest_path).get('dev', 'TestWorkspace', 'sales')
+        assert len(service.imports) == 1
+        assert counts['POST /groups/{id}/reports/{id}/Rebind'] == 1
+        assert service.workspaces[workspace_id]['datasets'][report['dataset_id']]['name'] == 'Sales v2'
+        assert entry.dataset_id == report['dataset_id']
+
+        make_pbix(pbix_path, data_model=b'changed' * 1000)
+        run_main(monkeypatch, service, tmp_path, [pbix_path], *args)
+        assert len(service.imports) == 2
+
+
+def test_main_resumes_journaled_imports_without_uploading_again(monkeypatch, tmp_path):
+    rdl_path = tmp_path / 'invoice.rdl'
+    rdl_path.write_text('<Report/>')
+    journal_path = tmp_path / 'journal.jsonl'
+
+    with FakePowerBI(import_delay=60) as service:
+        service.add_workspace('TestWorkspace', datasets=['Sales'])
+        with pytest.raises(SystemExit):
+            run_main(monkeypatch, service, tmp_path, [rdl_path], '--journal', str(journal_path),
+                     '--import-timeout', '0.2', '--poll-interval', '0.05')
+        stages = [json.loads(line)['stage'] for line in journal_path.read_text().splitlines()]
+        assert stages == ['prepared', 'uploaded']
+
+        service.import_delay = 0
+        run_main(monkeypatch, service, tmp_path, [rdl_path], '--journal', str(journal_path), '--resume', '--poll-interval', '0.05')
+
+        counts = service.request_counts()
+        assert counts['POST /groups/{id}/imports'] == 1
+        assert counts['POST /groups/{id}/reports/{id}/Default.UpdateDatasources'] == 1
+        assert not journal_path.exists()
+
+
+def test_resumed_reports_keep_their_manifest_hashes(monkeypatch, tmp_path):
+    pbix_path = make_pbix(tmp_path / 'sales.pbix')
+    rdl_path = tmp_path / 'invoice.rdl'
+    rdl_path.write_text('<Report/>')
+    args = ['--manifest', str(tmp_path / 'manifest.json'), '--poll-interval', '0.05']
+    journal = ['--journal', str(tmp_path / 'journal.jsonl')]
+
+    with FakePowerBI() as service:
+        service.add_workspace('TestWorkspace', datasets=['Sales'])
+        # The .pbix finishes, the .rdl stops after its import resolved
+        with patch('report_deployer.app.update_report_datasource', side_effect=requests.ConnectionError('reset')):
+            with pytest.raises(SystemExit):
+                run_main(monkeypatch, service, tmp_path, [pbix_path, rdl_path], *args, *journal)
+        run_main(monkeypatch, service, tmp_path, [pbix_path, rdl_path], *args, *journal, '--resume',
+                 '--run-report', str(tmp_path / 'run.json'))
+        skipped = {result['name']: result['skipped'] for result in json.loads((tmp_path / 'run.json').read_text())['reports']}
+        assert skipped == {'sales': True, 'invoice': False}
+
+        run_main(monkeypatch, service, tmp_path, [pbix_path, rdl_path], *args)
+        assert service.request_counts()['POST /groups/{id}/imports'] == 2
+
+
+def test_plan_then_apply_skips_lookups(monkeypatch, tmp_path):
+    pbix_path = make_pbix(tmp_path / 'sales.pbix')
+    rdl_path = tmp_path / 'invoice.rdl'
+    rdl_path.write_text('<Report/>')
+    plan_path = tmp_path / 'plan.json'
+
+    with FakePowerBI() as service:
+        workspace_id = service.add_workspace('TestWorkspace', datasets=['Sales'])
+        service.create_import(workspace_id, 'sales', b'old')
+        run_main(monkeypatch, service, tmp_path, [pbix_path, rdl_path], '--plan', str(plan_path), 'plan')
+
+        plan = json.loads(plan_path.read_text())
+        assert [(entry['name'], entry['existing'], entry['name_conflict']) for entry in plan['entries']] == [
+            ('sales', True, 'CreateOrOverwrite'), ('invoice', False, 'Abort'),
+        ]
+        lookups = service.request_counts()
+        assert 'POST /groups/{id}/imports' not in lookups
+
+        # The .rdl was published by someone else after planning, so its Abort conflicts and is resolved again
+        service.create_import(workspace_id, 'invoice.rdl', b'other')
+        run_main(monkeypatch, service, tmp_path, [], '--plan', str(plan_path), '--poll-interval', '0.05', 'apply')
+
+        counts = service.request_counts() - lookups
+        assert counts['GET /groups'] == 0
+        assert counts['GET /groups/{id}/datasets'] == 0
+        assert counts['GET /groups/{id}/imports'] == 1
+        assert counts['POST /groups/{id}/imports'] == 3
+        assert service.statuses[409] == 1
+
+        rdl_path.write_text('<Report>changed</Report>')
+        with pytest.raises(SystemExit):
+            run_main(monkeypatch, service, tmp_path, [], '--plan', str(plan_path), '--poll-interval', '0.05', 'apply')
+        assert (service.request_counts() - lookups)['POST /groups/{id}/imports'] == 4
+
+
+def test_assign_shards_is_balanced_and_deterministic():
+    sizes = {('dev', 'A'): 50, ('dev', 'B'): 30, ('prd', 'A'): 30, ('prd', 'B'): 20}
+    assignment = assign_shards(sizes, 2)
+    assert assignment == assign_shards(dict(reversed(sizes.items())), 2)
+    assert assignment == {('dev', 'A'): 1, ('dev', 'B'): 2, ('prd', 'A'): 2, ('prd', 'B'): 1}
+    assert parse_shard('2/3') == (2, 3)
+    for value in ('0/2', '3/2', 'two'):
+        with pytest.raises(ValueError):
+            parse_shard(value)
+
+
+def test_sharded_runs_merge_into_one_summary(monkeypatch, tmp_path):
+    sales_path = make_pbix(tmp_path / 'sales.pbix')
+    invoice_path = tmp_path / 'invoice.rdl'
+    invoice_path.write_text('<Report/>')
+    environments = {'dev': {'workspace': 'DevWorkspace'}, 'prd': {'workspace': 'ProdWorkspace'}}
+
+    with FakePowerBI() as service:
+        service.add_workspace('DevWorkspace', datasets=['Sales'])
+        service.add_workspace('ProdWorkspace', datasets=['Sales'])
+        for index in (1, 2):
+            run_main(monkeypatch, service, tmp_path, [sales_path, invoice_path], '--env', 'all', '--shard', f'{index}/2',
+                     '--poll-interval', '0.05', '--run-report', str(tmp_path / f'shard{index}.json'), environments=environments)
+            report = json.loads((tmp_path / f'shard{index}.json').read_text())
+            # Each workspace is deployed by a single runner
+            assert len({result['workspace'] for result in report['reports']}) == 1
+            assert len(report['reports']) == 2
+        assert service.request_counts()['POST /groups/{id}/imports'] == 4
+
+    reports = [str(tmp_path / 'shard1.json'), str(tmp_path / 'shard2.json')]
+    run_main(monkeypatch, service, tmp_path, [], '--shard-reports', *reports, '--run-report', str(tmp_path / 'merged.json'), 'merge')
+    merged = json.loads((tmp_path / 'merged.json').read_text())
+    assert sorted((result['environment'], result['name']) for result in merged['reports']) == [
+        ('dev', 'invoice'), ('dev', 'sales'), ('prd', 'invoice'), ('prd', 'sales'),
+    ]
+    assert merged['http']['POST /groups/{id}/imports']['requests'] == 4
+
+    with pytest.raises(SystemExit):
+        run_main(monkeypatch, service, tmp_path, [], '--shard-reports', reports[0], 'merge')
+
+
+def test_principal_pool_routes_by_access_and_throttling(monkeypatch, tmp_path, caplog):
+    pbix_path = make_pbix(tmp_path / 'sales.pbix')
+    principals_path = tmp_path / 'principals.yaml'
+    principals_path.write_text(yaml.safe_dump([{'client_id': 'spare', 'client_secret_env': 'SPARE_SECRET'}]))
+    monkeypatch.setenv('SPARE_SECRET', 'secret')
+    environments = {'dev': {'workspace': 'DevWorkspace'}, 'prd': {'workspace': 'ProdWorkspace'}}
+
+    with FakePowerBI() as service:
+        dev_id = service.add_workspace('DevWorkspace', datasets=['Sales'])
+        prod_id = service.add_workspace('ProdWorkspace', datasets=['Sales'])
+        # The main principal only sees the dev workspace and is throttled in it
+        service.access['client'] = {dev_id}
+        service.throttled_clients.add('client')
+        with caplog.at_level(logging.INFO):
+            run_main(monkeypatch, service, tmp_path, [pbix_path], '--env', 'all', '--principals', str(principals_path),
+                     '--poll-interval', '0.05', environments=environments)
+
+        clients = [service.token_clients.get(headers.get('Authorization', '')[len('Bearer '):]) for _, _, headers in service.requests]
+        assert not any(client == 'client' and prod_id in path for client, (_, path, _) in zip(clients, service.requests))
+        assert service.client_requests['spare'] > service.client_requests['client']
+    assert not any('retrying in 1.0s' in message for message in caplog.messages)
+    assert any(message.startswith('Service principal spare:') for message in caplog.messages)
+
+
+def test_job_queue_serializes_jobs_per_workspace():
+    active, overlaps, lock = [], [], threading.Lock()
+
+    def prepare(job):
+        job.workspaces = [job.env]
+
+    def run(job, state):
+        with lock:
+            overlaps.append((job.env, list(active)))
+            active.append(job.env)
+        time.sleep(0.2)
+        with lock:
+            active.remove(job.env)
+        return [DeploymentResult(name=job.files, succeeded=True)]
+
+    queue = JobQueue(prepare, run, workers=2)
+    jobs = [queue.submit({'files': name, 'env': env}) for name, env in (('first', 'A'), ('second', 'A'), ('third', 'B'))]
+    queue.close()
+    assert [job.status for job in jobs] == ['succeeded'] * 3
+    assert all(env not in others for env, others in overlaps)
+    assert ('B', ['A']) in overlaps
+    assert jobs[0].finished_at <= jobs[1].started_at
+    with pytest.raises(ValueError):
+        queue.submit({'files': 'first', 'env': 'A', 'status': 'succeeded'})
+
+
+def test_serve_keeps_lookups_warm_between_jobs(monkeypatch, tmp_path):
+    sales_path = make_pbix(tmp_path / 'sales.pbix')
+    invoice_path = tmp_path / 'invoice.rdl'
+    invoice_path.write_text('<Report/>')
+    config_path = tmp_path / 'config.yaml'
+    config_path.write_text(yaml.safe_dump({'reports': [
+        {'name': name, 'dataset': 'Sales', 'environment': {'dev': {'workspace': 'TestWorkspace'}}} for name in ('sales', 'invoice')
+    ]}))
+
+    with FakePowerBI() as service:
+        service.add_workspace('TestWorkspace', datasets=['Sales'])
+        for name, value in {'TENANT_ID': 'tenant', 'CLIENT_ID': 'client', 'CLIENT_SECRET': 'secret',
+                            'POWERBI_API_URL': service.api_url, 'POWERBI_AUTHORITY_URL': service.authority_url}.items():
+            monkeypatch.setenv(name, value)
+        monkeypatch.setattr('sys.argv', ['app.py', 'serve', '--config', str(config_path), '--listen', '127.0.0.1:0', '--poll-interval', '0.05'])
+        server = create_server(parse_arguments())
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+        try:
+            def deploy(**payload):
+                response = requests.post(f"{server.url}/jobs", json=payload)
+                assert response.status_code == 202
+                job = response.json()
+                while job['status'] in ('queued', 'running'):
+                    time.sleep(0.05)
+                    job = requests.get(f"{server.url}/jobs/{job['id']}").json()
+                return job
+
+            assert deploy(files=str(sales_path), env='dev')['status'] == 'succeeded'
+            before = service.request_counts()
+            job = deploy(files=f"{sales_path},{invoice_path}", env='dev')
+            assert job['status'] == 'succeeded'
+            assert [result['name'] for result in job['results']] == ['sales', 'invoice']
+
+            counts = service.request_counts() - before
+            assert counts['GET /groups'] == 0
+            assert counts['GET /groups/{id}/datasets'] == 0
+            assert counts['GET /groups/{id}/imports'] == 1
+            assert service.tokens_issued == 1
+
+            response = requests.post(f"{server.url}/jobs", json={'files': str(tmp_path / 'unknown.pbix'), 'env': 'dev'})
+            assert response.status_code == 400
+            assert requests.get(f"{server.url}/health").json()['jobs']['succeeded'] == 2
+        finally:
+            server.shutdown()
+            thread.join()
+
+
+def test_adaptive_limit_grows_on_success_and_halves_on_throttling():
+    assert endpoint_class('POST /groups/{id}/imports') == 'upload'
+    assert endpoint_class('GET /groups/{id}/imports/{id}') == 'poll'
+    assert endpoint_class('GET /groups/{id}/datasets') == 'metadata'
+
+    limit = AdaptiveLimit('metadata', limit=2.0, rate=1000.0, latency_spikes=False)
+    for _ in range(20):
+        limit.release(limit.acquire(), 200)
+    grown = limit.limit
+    assert grown > 4
+
+    first, second = limit.acquire(), limit.acquire()
+    limit.release(first, 429)
+    assert limit.limit == pytest.approx(grown / 2)
+    # Sent before the cut, so it does not cut again
+    limit.release(second, 429)
+    assert limit.limit == pytest.approx(grown / 2)
+    stats = limit.stats()
+    assert (stats['throttled'], stats['decreases'], stats['in_flight']) == (2, 1, 0)
+
+    # Retry-After is paid at the decreased rate, so the class pauses for Retry-After and not twice as long
+    limit = AdaptiveLimit('metadata', rate=10.0, latency_spikes=False)
+    limit.release(limit.acquire(), 429, retry_after=2.0)
+    assert limit.rate == pytest.approx(5.0)
+    assert (1.0 - limit.tokens) / limit.rate == pytest.approx(2.0, abs=0.01)
+
+    limit = AdaptiveLimit('upload', limit=1.0, rate=1000.0)
+    held = limit.acquire()
+    waiter = threading.Thread(target=lambda: limit.release(limit.acquire(), 200))
+    waiter.start()
+    time.sleep(0.1)
+    assert limit.stats()['queued'] == 1
+    limit.release(held, 200)
+    waiter.join()
+    assert limit.stats()['max_queued'] == 1
+
+
+def test_main_adapts_to_throttling(monkeypatch, tmp_path):
+    pbix_path = make_pbix(tmp_path / 'sales.pbix')
+    rdl_path = tmp_path / 'invoice.rdl'
+    rdl_path.write_text('<Report/>')
+
+    with FakePowerBI(throttle_rate=0.3, retry_after=0, seed=3) as service:
+        service.add_workspace('TestWorkspace', datasets=['Sales'])
+        run_main(monkeypatch, service, tmp_path, [pbix_path, rdl_path], '--adaptive', '--jobs', '2', '--poll-interval', '0.05',
+                 '--run-report', str(tmp_path / 'run.json'), '--metrics-file', str(tmp_path / 'run.prom'))
+
+    report = json.loads((tmp_path / 'run.json').read_text())
+    assert all(result['succeeded'] for result in report['reports'])
+    scheduler = report['scheduler']
+    assert sum(stats['throttled'] for stats in scheduler.values()) == service.statuses[429] > 0
+    assert sum(stats['decreases'] for stats in scheduler.values()) > 0
+    assert all(stats['in_flight'] == 0 and stats['queued'] == 0 for stats in scheduler.values())
+    openmetrics = (tmp_path / 'run.prom').read_text()
+    for stat in ('limit', 'rate', 'max_queued'):
+        assert f'# TYPE report_deployer_scheduler_{stat} gauge\nreport_deployer_scheduler_{stat}{{class="metadata"}}' in openmetrics
+
+
+def test_resolver_looks_up_again_after_a_failed_page():
+    page = MagicMock()
+    page.json.return_value = {'value': [{'name': 'Sales', 'id': 'dataset-id'}]}
+    client = MagicMock()
+    client.get.side_effect = [requests.HTTPError('503 Service Unavailable'), page]
+    resolver = WorkspaceResolver(client)
+    with pytest.raises(requests.HTTPError):
+        resolver.dataset_id('workspace-id', 'Sales')
+    assert resolver.dataset_id('workspace-id', 'Sales') == 'dataset-id'
+
+
+def test_main_writes_run_report(monkeypatch, tmp_path):
+    pbix_path = make_pbix(tmp_path / 'sales.pbix')
+    summary_path = tmp_path / 'summary.md'
+    monkeypatch.setenv('GITHUB_STEP_SUMMARY', str(summary_path))
+
+    with FakePowerBI() as service:
+        service.add_workspace('TestWorkspace', datasets=['Sales'])
+        run_main(monkeypatch, service, tmp_path, [pbix_path], '--poll-interval', '0.05',
+                 '--run-report', str(tmp_path / 'run.json'), '--metrics-file', str(tmp_path / 'run.prom'),
+                 '--profile', '--profile-dir', str(tmp_path / 'profile'))
+
+    report = json.loads((tmp_path / 'run.json').read_text())
+    assert set(report['stages']) == {'resolve', 'prepare', 'upload', 'poll'}
+    assert all(span['report'] == 'sales' for span in report['spans'])
+    assert report['counters']['bytes_uploaded'] > 0
+    assert report['http']['POST /groups/{id}/imports']['requests'] == 1
+    assert report['reports'][0]['succeeded'] is True
+    openmetrics = (tmp_path / 'run.prom').read_text()
+    assert 'report_deployer_stage_seconds_count{stage="upload"} 1' in openmetrics
+    family = None
+    for line in openmetrics.splitlines()[:-1]:
+        if line.startswith('# TYPE '):
+            family = line.split()[2]
+        else:
+            assert line.startswith(family + ('_total' if line.split('{')[0].endswith('_total') else ''))
+    assert '| sales | TestWorkspace | deployed |' in summary_path.read_text()
+    assert (tmp_path / 'profile' / 'upload.pstats').exists()
+
+
+def test_lookups_page_lazily_and_filter_server_side():
+    with FakePowerBI(page_size=2) as service:
+        workspace_id = service.add_workspace("O'Brien Reports", datasets=[f'dataset{i}' for i in range(7)])
+        service.add_workspace('Other', datasets=['dataset0'])
+        client = PowerBIClient('mock_access_token', base_url=service.api_url)
+
+        assert get_workspace_id(client, "O'Brien Reports") == workspace_id
+        get_dataset_id(client, workspace_id, 'dataset1')
+        assert service.request_counts()['GET /groups/{id}/datasets'] == 1
+        get_dataset_id(client, workspace_id, 'dataset6')
+        assert service.request_counts()['GET /groups/{id}/datasets'] == 1 + 4
+        with pytest.raises(NotFoundError):
+            get_dataset_id(client, workspace_id, 'missing')
+
+
+def test_resolver_admin_scan_resolves_datasets_without_workspace_calls():
+    with FakePowerBI() as service:
+        workspace_id = service.add_workspace('TestWorkspace', datasets=['TestDataset'])
+        client = PowerBIClient('mock_access_token', base_url=service.api_url)
+        resolver = WorkspaceResolver(client, admin_scan=True)
+
+        assert resolver.workspace_id('TestWorkspace') == workspace_id
+        assert resolver.dataset_id(workspace_id, 'TestDataset') is not None
+        assert set(service.request_counts()) == {'GET /admin/groups'}
+
+
+def test_compile_config_reports_every_error_at_once():
+    raw = {'reports': [
+        {'name': 'sales', 'environment': {'dev': {'workspace': 'Sales'}}},
+        {'name': 'finance', 'dataset': 'Finance', 'environment': {'dev': {}}},
+        {'name': 'hr', 'dataset': 'HR', 'environment': {'dev': {'workspace': 'People'}}},
+        {'name': 'hr', 'dataset': 'HR', 'environment': {'dev': {'workspace': 'People'}}},
+    ]}
+
+    with pytest.raises(ConfigError) as error:
+        compile_config(raw)
+    assert error.value.errors == [
+        "report 'sales' dataset: Field required",
+        "report 'finance' environment.dev.workspace: Field required",
+    ]
+
+    with pytest.raises(ConfigError, match="report 'hr': defined 2 times"):
+        compile_config({'reports': raw['reports'][2:]})
+
+    with pytest.raises(ConfigError) as error:
+        compile_config({'reports': [
+            {'name': 'hr', 'dataset': 'HR', 'environment': {'dev': {'workspace': 'People'}, 'prod': {'workspace': 'People'}}},
+            {'name': 'hr_v2', 'display_name': 'hr', 'dataset': 'HR', 'environment': {'dev': {'workspace': 'People'}}},
+        ]})
+    assert error.value.errors == ["reports 'hr', 'hr_v2': all publish 'hr' to workspace 'People' in dev"]
+
+
+def test_config_index_and_compiled_cache(tmp_path):
+    config_path = tmp_path / 'config.yaml'
+    config_path.write_text(yaml.safe_dump({'reports': [
+        {'name': 'sales', 'display_name': 'Sales Overview', 'dataset': 'Sales',
+         'environment': {'dev': {'workspace': 'Shared'}, 'prod': {'workspace': 'Sales', 'subfolder': 'folder_id'}}},
+        {'name': 'finance', 'dataset': 'Finance', 'environment': {'dev': {'workspace': 'Shared'}}},
+    ]}))
+    cache_dir = tmp_path / 'compiled'
+
+    config = load_config(config_path, cache_dir)
+    assert config.report('sales').report_name == 'Sales Overview'
+    assert [report.name for report in config.reports_in_workspace('dev', 'Shared')] == ['sales', 'finance']
+    assert config.workspaces('prod') == ['Sales']
+    assert config.environments() == ['dev', 'prod']
+    assert validate_files([{'file_without_extension': 'finance'}], config, None) == []
+    assert validate_files([{'file_without_extension': 'finance'}, {'file_without_extension': 'missing'}], config, ['prod']) == [
+        'Environment prod not found for finance',
+        'File missing not in the configuration file',
+    ]
+
+    with patch('report_deployer.config.yaml.safe_load') as safe_load:
+        cached = load_config(config_path, cache_dir)
+    safe_load.assert_not_called()
+    assert cached.report('sales').environment['prod'].subfolder == 'folder_id'
+    assert len(cached.reports_in_workspace('dev', 'Shared')) == 2
+    assert len(list(cache_dir.iterdir())) == 1
+
+    # A config model with new fields does not read the old compiled form
+    with patch('report_deployer.config.DeploymentConfig.model_json_schema', return_value={'changed': True}):
+        load_config(config_path, cache_dir)
+    assert len(list(cache_dir.iterdir())) == 2